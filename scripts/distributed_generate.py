@@ -0,0 +1,34 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import argparse
+import logging
+import os
+
+from pathlib import Path
+
+from storygen.common.config import Config
+from storygen.common.llm.prompt import load_prompts
+from storygen.common.util import *
+from storygen.story.distributed import *
+
+
+# run a queue of premise/plan/story jobs as ray tasks, on a ray cluster or (with local_mode) in this process.
+# each step uses its own config and prompts from premise/, plan/ and story/; the DISTRIBUTED section of story/config.yaml
+# configures the run itself.
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', nargs='+', default=['defaults'])
+    args = parser.parse_args()
+
+    scripts_path = os.path.dirname(os.path.realpath(__file__))
+    configs = {step: Config.load(Path(scripts_path) / step, args.configs) for step in ['premise', 'plan', 'story']}
+    prompts = {step: load_prompts(Path(scripts_path) / step) for step in ['premise', 'plan', 'story']}
+    init_logging(configs['story']['logging_level'])
+
+    distributed_config = configs['story']['distributed']
+    init_ray(distributed_config)
+    jobs = load_job_manifest(distributed_config['manifest_path'])
+    os.makedirs(os.path.dirname(distributed_config['results_path']), exist_ok=True)
+    num_ok, num_failed = run_jobs(jobs, configs, prompts, distributed_config)
+    logging.info(f'Finished {num_ok} jobs ({num_failed} failed); results in {distributed_config["results_path"]}')
@@ -0,0 +1,92 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import argparse
+import json
+import logging
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from storygen.common.llm.backends import MockEngine, make_completion
+from storygen.common.server import *
+from storygen.common.util import *
+
+
+# a stand-in for an openai-compatible model server (/v1/completions and /v1/chat/completions), answering with
+# the deterministic mock engine after a simulated delay. at most max_batch requests are generated at once and the
+# rest queue, so it saturates like a real server and scripts/replay.py can be tried without a gpu. set server_type
+# vllm with this host and port to run the pipeline against it over http.
+
+def generate(prompt, params):
+    # run a private mock engine to completion, returning the completion and the number of decoding steps it took
+    engine = MockEngine(None)
+    engine.add_request('0', prompt, params)
+    num_steps, output = 0, None
+    while engine.has_unfinished_requests():
+        output = engine.step()[0]
+        num_steps += 1
+    _, texts, finish_reasons, logprobs, usage = output
+    return make_completion(texts, finish_reasons, logprobs=logprobs if params.get('logprobs', None) is not None else None, usage=usage), num_steps
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path not in ['/v1/completions', '/v1/chat/completions']:
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        is_chat = self.path == '/v1/chat/completions'
+        prompt = '\n\n'.join([message['content'] for message in body['messages']]) if is_chat else body['prompt']
+        with self.server.batch_slots:
+            completion, num_steps = generate(prompt, body)
+            time.sleep(self.server.seconds_per_prompt_token * completion['usage']['prompt_tokens'] + self.server.seconds_per_token * num_steps)
+        if is_chat:
+            for choice in completion['choices']:
+                choice['message'] = {'role': 'assistant', 'content': choice.pop('text')}
+        completion.update({'id': 'mock', 'object': 'chat.completion' if is_chat else 'text_completion', 'created': int(time.time()), 'model': body.get('model', 'mock')})
+        if body.get('stream', False):
+            # no point pacing the chunks out; the delay above already covers the whole generation
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            chunk = {key: value for key, value in completion.items() if key not in ['choices', 'usage']} # streams don't report usage
+            for choice in completion['choices']:
+                text = choice['message']['content'] if is_chat else choice['text']
+                pieces = [piece for piece in text.split(' ') if piece != '']
+                for i, piece in enumerate(pieces):
+                    chunk_choice = {'index': choice['index'], 'finish_reason': choice['finish_reason'] if i == len(pieces) - 1 else None}
+                    if is_chat:
+                        chunk_choice['delta'] = {'content': ' ' + piece}
+                    else:
+                        chunk_choice['text'] = ' ' + piece
+                    self.wfile.write(f"data: {json.dumps({**chunk, 'choices': [chunk_choice]})}\n\n".encode('utf-8'))
+            self.wfile.write(b'data: [DONE]\n\n')
+            return
+        data = json.dumps(completion).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--max_batch', type=int, default=16, help='requests generated at once; further requests queue')
+    parser.add_argument('--seconds_per_token', type=float, default=0.02, help='simulated decoding time per generated token')
+    parser.add_argument('--seconds_per_prompt_token', type=float, default=0.0001, help='simulated prefill time per prompt token')
+    parser.add_argument('--logging_level', type=str, default='info')
+    args = parser.parse_args()
+    init_logging(args.logging_level)
+
+    server = ThreadingHTTPServer(('localhost', args.port), MockHandler)
+    server.batch_slots = threading.BoundedSemaphore(args.max_batch)
+    server.seconds_per_token = args.seconds_per_token
+    server.seconds_per_prompt_token = args.seconds_per_prompt_token
+    logging.info(f"Mock model server listening on {LOCALHOST}:{args.port}")
+    server.serve_forever()
@@ -10,8 +10,10 @@ from storygen.common.llm.prompt import load_prompts
 from storygen.premise.premise import Premise
 from storygen.plan.plan import Plan
 from storygen.plan.plan_writer import *
+from storygen.plan.journal import PlanJournal
 from storygen.common.config import Config
 from storygen.common.util import *
+from storygen.common.trace import start_tracing, stop_tracing
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
@@ -21,42 +23,29 @@ if __name__=='__main__':
     dir_path = os.path.dirname(os.path.realpath(__file__))
     config = Config.load(Path(dir_path), args.configs)
     init_logging(config['logging_level'])
+    if config.get('trace_path', None) is not None:
+        os.makedirs(os.path.dirname(config['trace_path']), exist_ok=True)
+        start_tracing()
 
     premise = Premise.load(config['premise_path'])
     prompts = load_prompts(Path(dir_path))
 
-    client = LLMClient()
-
-    plan = Plan(premise)
-
-    generate_setting(plan, client, prompts['setting'], config['model']['setting'])
-    logging.info(f'Generated setting: {plan.setting}')
-
-    success = False
-    for i in range(config['model']['entity']['max_attempts']):
-        try:
-            generate_entities(plan, client, prompts['entity'], config['model']['entity'])
-            success = True
-            break
-        except:
-            logging.warning(f'Failed to generate entities, retrying ({i+1}/{config["model"]["entity"]["max_attempts"]})')
-    if not success:
-        raise Exception('Failed to generate entities')
-    logging.info(f'Generated entities: {plan.entity_list}')
-
-    success = False
-    for i in range(config['model']['outline']['max_attempts']):
-        # TODO retry mechanism could be more sophisticated if needed, e.g. beam search or MCTS, similar to how we do it in generate_story
-        try:
-            generate_outline(plan, client, prompts['outline'], config['model']['outline'])
-            success = True
-            break
-        except:
-            logging.warning(f'Failed to generate outline, retrying ({i+1}/{config["model"]["outline"]["max_attempts"]})')
-    if not success:
-        raise Exception('Failed to generate outline')
+    if config.get('record_requests_path', None) is not None:
+        os.makedirs(os.path.dirname(config['record_requests_path']), exist_ok=True)
+    client = LLMClient(requests_per_minute=config.get('requests_per_minute', None), tokens_per_minute=config.get('tokens_per_minute', None), record_path=config.get('record_requests_path', None))
+
+    journal = None
+    if config.get('journal_path', None) is not None:
+        os.makedirs(os.path.dirname(config['journal_path']), exist_ok=True)
+        journal = PlanJournal(config['journal_path'], premise)
+
+    plan = generate_plan(premise, prompts, config['model'], client, journal=journal)
     
     logging.info(f'Generated plan: {plan}')
 
     os.makedirs(os.path.dirname(config['output_path']), exist_ok=True)
-    plan.save(config['output_path'])
\ No newline at end of file
+    plan.save(config['output_path'])
+    if journal is not None and config.get('delete_journal', True):
+        journal.delete()
+
+    stop_tracing(config.get('trace_path', None))
@@ -2,6 +2,7 @@
 
 import argparse
 import os
+import sys
 
 from pathlib import Path
 
@@ -11,6 +12,7 @@ from storygen.premise.premise import Premise
 from storygen.premise.premise_writer import *
 from storygen.common.config import Config
 from storygen.common.util import *
+from storygen.common.trace import start_tracing, stop_tracing
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
@@ -20,10 +22,29 @@ if __name__=='__main__':
     dir_path = os.path.dirname(os.path.realpath(__file__))
     config = Config.load(Path(dir_path), args.configs)
     init_logging(config.logging_level)
+    if config.get('trace_path', None) is not None:
+        os.makedirs(os.path.dirname(config['trace_path']), exist_ok=True)
+        start_tracing()
 
     prompts = load_prompts(Path(dir_path))
 
-    llm_client = LLMClient()
+    if config.get('record_requests_path', None) is not None:
+        os.makedirs(os.path.dirname(config['record_requests_path']), exist_ok=True)
+    llm_client = LLMClient(requests_per_minute=config.get('requests_per_minute', None), tokens_per_minute=config.get('tokens_per_minute', None), record_path=config.get('record_requests_path', None))
+
+    if config['bulk']['num_premises'] > 0:
+        os.makedirs(os.path.dirname(config['bulk']['output_path']), exist_ok=True)
+        num_premises = generate_premises_bulk(
+            prompts['title'], 
+            config['model']['title'], 
+            prompts['premise'], 
+            config['model']['premise'], 
+            llm_client, 
+            config['bulk']
+        )
+        logging.info(f'Generated {num_premises} premises in {config["bulk"]["output_path"]}')
+        stop_tracing(config.get('trace_path', None))
+        sys.exit()
 
     premise = Premise()
     generate_title(premise, prompts['title'], config['model']['title'], llm_client)
@@ -32,4 +53,6 @@ if __name__=='__main__':
     logging.info(f'Generated premise: {premise.premise}')
 
     os.makedirs(os.path.dirname(config['output_path']), exist_ok=True)
-    premise.save(config['output_path'])
\ No newline at end of file
+    premise.save(config['output_path'])
+
+    stop_tracing(config.get('trace_path', None))
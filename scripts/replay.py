@@ -0,0 +1,62 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import argparse
+import json
+import logging
+import math
+
+from storygen.common.llm.replay import *
+from storygen.common.server import *
+from storygen.common.util import *
+
+
+# replay requests recorded with record_requests_path against a server, at increasing load, to find how much load one
+# server sustains. e.g. to check a single vllm replica against the load of 1 to 16 stories generated at once:
+#   python replay.py --trace output/story_requests.jsonl --engine meta-llama/Llama-2-7b-chat-hf --port 9741 --copies 1 2 4 8 16
+# or try it without a gpu against mock_server.py.
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trace', type=str, required=True, help='requests recorded with record_requests_path')
+    parser.add_argument('--engine', type=str, required=True, help='model name to send to the target server')
+    parser.add_argument('--server_type', type=str, default='vllm', help='any registered backend, e.g. vllm, openai, vllm-engine or mock')
+    parser.add_argument('--host', type=str, default=LOCALHOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--tensor_parallel_size', type=int, default=1)
+    parser.add_argument('--rate_scales', type=float, nargs='+', default=[1.0], help='divide the recorded think times (or open-loop start times) by each of these')
+    parser.add_argument('--copies', type=int, nargs='+', default=[1], help='replay this many copies of the trace at once, e.g. to simulate that many concurrent stories')
+    parser.add_argument('--max_in_flight', type=int, default=None, help='client-side cap on concurrent requests, like max_in_flight_requests')
+    parser.add_argument('--open_loop', action='store_true', help='issue requests at their recorded start times, ignoring which requests they waited on')
+    parser.add_argument('--time_limit', type=int, default=120)
+    parser.add_argument('--demand', type=float, default=None, help='load to plan for, in multiples of the recorded load (rate scale x copies); reports the replicas needed for it')
+    parser.add_argument('--output', type=str, default=None, help='write the summaries as json here')
+    parser.add_argument('--logging_level', type=str, default='info')
+    args = parser.parse_args()
+    init_logging(args.logging_level)
+
+    records = load_trace(args.trace)
+    server_config = ServerConfig(args.engine, args.host, args.port, args.server_type, args.tensor_parallel_size)
+    summaries = []
+    for rate_scale in args.rate_scales:
+        for copies in args.copies:
+            logging.info(f"Replaying {len(records)} requests x{copies} at {rate_scale}x the recorded rate...")
+            results = replay(records, server_config, rate_scale=rate_scale, copies=copies, max_in_flight=args.max_in_flight, respect_dependencies=not args.open_loop, time_limit=args.time_limit)
+            summaries.append(summarize_replay(results, rate_scale=rate_scale, copies=copies))
+            logging.info(format_summary(summaries[-1]))
+
+    saturated = find_saturation(summaries)
+    if saturated is None:
+        max_load = max([summary['rate_scale'] * summary['copies'] for summary in summaries])
+        logging.info(f"The server kept up with every load tried, up to {max_load}x the recorded load")
+    else:
+        # the last load before saturation is what one server is known to sustain
+        sustained = [summary for summary in summaries if summary['rate_scale'] * summary['copies'] < saturated['rate_scale'] * saturated['copies']]
+        max_load = max([summary['rate_scale'] * summary['copies'] for summary in sustained], default=None)
+        logging.info(f"Saturated at {saturated['rate_scale'] * saturated['copies']}x the recorded load (rate x{saturated['rate_scale']}, {saturated['copies']} copies); "
+                     f"one server sustains {f'{max_load}x' if max_load is not None else 'less than the lightest load tried'}")
+    if args.demand is not None and max_load is not None:
+        logging.info(f"Replicas needed for {args.demand}x the recorded load: {math.ceil(args.demand / max_load)}")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'summaries': summaries, 'saturated': saturated}, f, indent=4)
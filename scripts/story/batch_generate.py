@@ -0,0 +1,51 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import argparse
+import os
+
+from pathlib import Path
+
+from storygen.common.llm.llm import LLMClient
+from storygen.common.llm.prompt import load_prompts
+from storygen.story.batch import *
+from storygen.common.config import Config
+from storygen.common.util import *
+from storygen.common.trace import start_tracing, stop_tracing
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', nargs='+', default=['defaults'])
+    args = parser.parse_args()
+
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    config = Config.load(Path(dir_path), args.configs)
+    init_logging(config['logging_level'])
+    if config.get('trace_path', None) is not None:
+        os.makedirs(os.path.dirname(config['trace_path']), exist_ok=True)
+        start_tracing()
+    if config.get('record_requests_path', None) is not None:
+        os.makedirs(os.path.dirname(config['record_requests_path']), exist_ok=True)
+
+    prompts = load_prompts(Path(dir_path))
+
+    # one client for the whole batch, so max_in_flight_requests is a global limit across all stories
+    client = LLMClient(
+        max_in_flight=config.get('max_in_flight_requests', None),
+        requests_per_minute=config.get('requests_per_minute', None),
+        tokens_per_minute=config.get('tokens_per_minute', None),
+        track_prefix_cache=config.get('track_prefix_cache', False),
+        record_path=config.get('record_requests_path', None),
+    )
+
+    batch_config = config['batch']
+    entries = load_story_manifest(batch_config['manifest_path'], batch_config['output_dir'])
+    os.makedirs(os.path.dirname(batch_config['results_path']), exist_ok=True)
+    if batch_config.get('checkpoint_dir', None) is not None:
+        os.makedirs(batch_config['checkpoint_dir'], exist_ok=True)
+
+    num_ok, num_failed = generate_stories_batch(entries, config['model']['story'], prompts['story'], client, batch_config)
+    logging.info(f'Generated {num_ok} stories ({num_failed} failed); results in {batch_config["results_path"]}')
+    if client.prefix_stats is not None:
+        logging.info(f'Estimated prefix cache reuse by stage:\n{client.prefix_stats}')
+
+    stop_tracing(config.get('trace_path', None))
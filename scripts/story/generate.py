@@ -10,8 +10,10 @@ from storygen.common.llm.llm import LLMClient
 from storygen.common.llm.prompt import load_prompts
 from storygen.plan.plan import Plan
 from storygen.story.story_writer import *
+from storygen.story.export import *
 from storygen.common.config import Config
 from storygen.common.util import *
+from storygen.common.trace import start_tracing, stop_tracing
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
@@ -21,26 +23,68 @@ if __name__=='__main__':
     dir_path = os.path.dirname(os.path.realpath(__file__))
     config = Config.load(Path(dir_path), args.configs)
     init_logging(config['logging_level'])
+    if config.get('trace_path', None) is not None:
+        os.makedirs(os.path.dirname(config['trace_path']), exist_ok=True)
+        start_tracing()
+    if config.get('record_requests_path', None) is not None:
+        os.makedirs(os.path.dirname(config['record_requests_path']), exist_ok=True)
 
     plan = Plan.load(config['plan_path'])
     prompts = load_prompts(Path(dir_path))
 
-    client = LLMClient()
+    client = LLMClient(
+        max_in_flight=config.get('max_in_flight_requests', None),
+        requests_per_minute=config.get('requests_per_minute', None),
+        tokens_per_minute=config.get('tokens_per_minute', None),
+        track_prefix_cache=config.get('track_prefix_cache', False),
+        record_path=config.get('record_requests_path', None),
+    )
+
+    if config.get('checkpoint_path', None) is not None:
+        os.makedirs(os.path.dirname(config['checkpoint_path']), exist_ok=True)
     
-    story = generate_story(
-        plan, 
-        config['model']['story'], 
-        prompts['story'], 
-        client, 
-        intermediate_save_prefix=config['intermediate_prefix'],
-        delete_old_intermediates=config['delete_old_intermediates'],
-    )[0]
+    checkpoint_kwargs = dict(
+        checkpoint_path=config.get('checkpoint_path', None),
+        checkpoint_passages=config.get('checkpoint_passages', True),
+        delete_checkpoint=config.get('delete_checkpoint', True),
+    )
+    # scored candidates are kept from the story's events, to export along with the story
+    candidates = CandidateCollector() if config.get('export_dataset_path', None) is not None and config.get('export_candidates', True) else None
+    os.makedirs(os.path.dirname(config['output_path']), exist_ok=True)
+    if config.get('stream_output', False):
+        # write passages to the output file as soon as every beam member agrees on them
+        streamed_text = ''
+        with open(config['output_path'], 'w') as f:
+            for event in stream_story(plan, config['model']['story'], prompts['story'], client, **checkpoint_kwargs):
+                if candidates is not None:
+                    candidates.on_event(event)
+                if event['type'] == 'passage_committed':
+                    f.write(event['text'])
+                    f.flush()
+                    streamed_text += event['text']
+                elif event['type'] == 'story_finished':
+                    story = event['beam'][0]
+        if str(story).startswith(streamed_text):
+            with open(config['output_path'], 'a') as f:
+                f.write(str(story)[len(streamed_text):])
+        else:
+            # the ending truncated some of the streamed text, so replace the file atomically
+            story.save(config['output_path'] + '.tmp')
+            os.replace(config['output_path'] + '.tmp', config['output_path'])
+    else:
+        story = generate_story(plan, config['model']['story'], prompts['story'], client, event_callback=candidates.on_event if candidates is not None else None, **checkpoint_kwargs)[0]
+        story.save(config['output_path'])
+    if config.get('export_dataset_path', None) is not None:
+        num_rows = export_story(config['export_dataset_path'], story, Path(config['plan_path']).stem, new_run_id(), candidates=candidates.candidates if candidates is not None else ())
+        logging.info(f"Exported {num_rows} passages to {config['export_dataset_path']}")
 
     logging.info(f'Generated story: {story}')
-
-    os.makedirs(os.path.dirname(config['output_path']), exist_ok=True)
-    story.save(config['output_path'])
+    logging.info(f'LLM usage: {client.usage}')
+    if client.prefix_stats is not None:
+        logging.info(f'Estimated prefix cache reuse by stage:\n{client.prefix_stats}')
 
     os.makedirs(os.path.dirname(config['output_pkl']), exist_ok=True)
     with open(config['output_pkl'], 'wb') as f:
-        pickle.dump(story, f)
\ No newline at end of file
+        pickle.dump(story, f)
+
+    stop_tracing(config.get('trace_path', None))
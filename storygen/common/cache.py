@@ -0,0 +1,54 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+
+
+class ComputeCache:
+    # thread-safe memo of computed values, optionally bounded in size with least-recently-used eviction.
+    # concurrent requests for the same key wait on a single computation instead of each computing it themselves.
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.entries = OrderedDict() # key -> Future
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                future, is_owner = self.entries[key], False
+            else:
+                self.misses += 1
+                future, is_owner = Future(), True
+                self.entries[key] = future
+                if self.max_size is not None and len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        if is_owner:
+            try:
+                future.set_result(compute())
+            except BaseException as e:
+                # don't cache failures; the next request for this key retries
+                with self.lock:
+                    if self.entries.get(key) is future:
+                        del self.entries[key]
+                future.set_exception(e)
+        return future.result()
+
+    def retain(self, keys):
+        # evict every entry whose key isn't in keys
+        with self.lock:
+            for key in [key for key in self.entries if key not in keys]:
+                del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def __str__(self):
+        return f'{self.hits} hits, {self.misses} misses ({100 * self.hit_rate():.1f}% hit rate)'
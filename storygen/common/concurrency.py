@@ -0,0 +1,17 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+
+
+def concurrent_map(fn, items, max_workers=None):
+    # apply fn to every item concurrently and return the results in input order, so the outcome doesn't depend on
+    # which request finishes first. exceptions propagate to the caller. each worker runs in a copy of the caller's
+    # context, so context variables (e.g. tracing state) carry over. the number of requests actually in flight
+    # is capped separately by the LLMClient, so nesting these calls can't deadlock.
+    items = list(items)
+    if len(items) <= 1 or max_workers == 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(len(items), max_workers or len(items))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, fn, item) for item in items]
+        return [future.result() for future in futures]
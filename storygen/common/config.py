@@ -60,6 +60,10 @@ class Config:
     def __contains__(self, name):
         return name in self.config
 
+    def override(self, **overrides):
+        # shallow copy with some keys replaced; everything else, including inherited keys, resolves as before
+        return Config({**self.config, **overrides}, self.parent_config)
+
     def get(self, name, default=None):
         try:
             return self[name]
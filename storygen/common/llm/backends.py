@@ -0,0 +1,317 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import hashlib
+import itertools
+import logging
+import os
+import queue
+import random
+import threading
+
+import openai
+
+from storygen.common.llm.scheduler import estimate_prompt_tokens
+from storygen.common.util import *
+
+
+# a backend serves completion and chat requests for one server config. both calls take the prompt (a string, or a list
+# of messages for chat) and a dict of openai-style sampling params as from SamplingConfig.dict(), and return an
+# openai-format completion: {'choices': [{'index', 'text' (or 'message': {'role', 'content'} for chat), 'finish_reason',
+# 'logprobs': {'tokens', 'top_logprobs'}}], 'usage': {'prompt_tokens', 'completion_tokens'}}.
+# doomed(partial_text), if given with stream=True, says whether a candidate will certainly be rejected, so the backend
+# can stop generating it early and mark it with finish_reason 'doomed'.
+BACKENDS = {} # server_type -> backend class
+
+backends = {} # server config -> backend instance, shared by all clients in this process
+backends_lock = threading.Lock()
+
+
+def register_backend(*server_types):
+    def register(backend_class):
+        for server_type in server_types:
+            BACKENDS[server_type] = backend_class
+        return backend_class
+    return register
+
+
+def get_backend(server_config):
+    with backends_lock:
+        if server_config not in backends:
+            if server_config['server_type'] not in BACKENDS:
+                raise NotImplementedError(f"Engine type {server_config['server_type']} not implemented.")
+            backends[server_config] = BACKENDS[server_config['server_type']](server_config)
+        return backends[server_config]
+
+
+time_limit_context = time_limit # backends take the number of seconds as time_limit
+
+
+@register_backend('openai', 'vllm')
+class HTTPBackend:
+    # an openai-compatible server, called through the openai module: the openai API itself, or a vllm api_server
+    def __init__(self, server_config):
+        self.server_config = server_config
+        # credentials are passed per request rather than set on the openai module, so concurrent calls to different servers don't race
+        if server_config['server_type'] == 'openai':
+            self.api_key = os.environ['OPENAI_API_KEY']
+            self.api_base = 'https://api.openai.com/v1'
+        else:
+            self.api_key = "EMPTY"
+            self.api_base = server_config['host'] + ':' + str(server_config['port']) + '/v1'
+        self.warned_logit_bias = False
+
+    def complete(self, prompt, params, stream=False, doomed=None, time_limit=30):
+        params = {key: value for key, value in params.items() if key != 'logit_bias'} # vllm doesn't yet support logit bias
+        with time_limit_context(time_limit):
+            completion = openai.Completion.create(prompt=prompt, api_key=self.api_key, api_base=self.api_base, request_timeout=time_limit, stream=stream, **params)
+            if stream:
+                completion = consume_stream(completion, params, prompt, is_chat=False, doomed=doomed)
+        return completion
+
+    def chat(self, messages, params, stream=False, doomed=None, time_limit=30):
+        if self.server_config['server_type'] == 'vllm' and 'logit_bias' in params and not self.warned_logit_bias:
+            logging.warning(f"Logit bias is not supported for vllm server.")
+            self.warned_logit_bias = True
+        with time_limit_context(time_limit):
+            completion = openai.ChatCompletion.create(messages=messages, api_key=self.api_key, api_base=self.api_base, request_timeout=time_limit, stream=stream, **params)
+            if stream:
+                completion = consume_stream(completion, params, messages, is_chat=True, doomed=doomed)
+        return completion
+
+
+def consume_stream(chunks, params, prompt, is_chat=False, doomed=None):
+    # read a streamed completion into the same shape as a non-streamed one. doomed candidates stop accumulating text
+    # and are marked with finish_reason 'doomed', and the stream is closed as soon as every candidate is finished or doomed.
+    # streamed responses don't report usage, so completion tokens are counted as chunks and prompt tokens estimated
+    n = params.get('n', None) or 1
+    texts, finish_reasons, num_chunks = [''] * n, [None] * n, [0] * n
+    server_finished = [False] * n
+    for chunk in chunks:
+        for choice in chunk['choices']:
+            i = choice['index']
+            num_chunks[i] += 1
+            server_finished[i] = server_finished[i] or choice.get('finish_reason', None) is not None
+            if finish_reasons[i] is not None:
+                continue
+            texts[i] += (choice['delta'].get('content', '') if is_chat else choice['text']) or ''
+            if choice.get('finish_reason', None) is not None:
+                finish_reasons[i] = choice['finish_reason']
+            elif doomed is not None and doomed(texts[i]):
+                finish_reasons[i] = 'doomed'
+        if all([finish_reason is not None for finish_reason in finish_reasons]):
+            break
+    if hasattr(chunks, 'close'):
+        chunks.close()
+    # we stopped reading doomed candidates the server hadn't finished. closing the stream's generator doesn't reliably
+    # abort the http request, so the server may keep generating them; this only counts the reads skipped
+    tokens_unread = sum([max(0, (params.get('max_tokens', None) or 16) - num_chunks[i]) for i in range(n) if not server_finished[i]])
+    if tokens_unread > 0:
+        logging.debug(f"Stopped streaming after all candidates finished or were doomed; skipped reading up to {tokens_unread} tokens")
+    return make_completion(texts, [finish_reason or 'length' for finish_reason in finish_reasons], is_chat=is_chat,
+                           usage={'prompt_tokens': estimate_prompt_tokens(prompt), 'completion_tokens': sum(num_chunks), 'tokens_unread': tokens_unread})
+
+
+def make_completion(texts, finish_reasons, is_chat=False, logprobs=None, usage=None):
+    choices = []
+    for i, text in enumerate(texts):
+        choice = {'index': i, 'finish_reason': finish_reasons[i], 'logprobs': logprobs[i] if logprobs is not None else None}
+        if is_chat:
+            choice['message'] = {'role': 'assistant', 'content': text}
+        else:
+            choice['text'] = text
+        choices.append(choice)
+    return {'choices': choices, 'usage': usage or {}}
+
+
+@register_backend('vllm-engine', 'mock')
+class InProcessBackend:
+    # drives an engine in this process directly, without an http server in between. requests from all threads are
+    # queued to a single loop thread that owns the engine and steps it, so concurrent requests are batched together
+    # the same way the vllm server would batch them.
+    # an engine has add_request(request_id, prompt, params), abort_request(request_id), has_unfinished_requests(),
+    # and step(), which advances every request and returns [(request_id, texts, finish_reasons, logprobs, usage)]
+    # with each request's candidates so far (finish_reason None while a candidate is still generating)
+    def __init__(self, server_config):
+        self.server_config = server_config
+        self.engine = ENGINES[server_config['server_type']](server_config)
+        self.pending = queue.Queue()
+        self.requests = {} # request id -> (future, doomed, max_tokens, {index: doomed candidate}); only touched by the loop thread
+        self.request_ids = itertools.count()
+        self.loop_thread = threading.Thread(target=self.loop, daemon=True)
+        self.loop_thread.start()
+
+    def complete(self, prompt, params, stream=False, doomed=None, time_limit=30):
+        return self.submit(prompt, params, doomed=doomed if stream else None, time_limit=time_limit)
+
+    def chat(self, messages, params, stream=False, doomed=None, time_limit=30):
+        if not hasattr(self.engine, 'render_chat'):
+            raise NotImplementedError(f"Engine type {self.server_config['server_type']} doesn't support chat prompts; use a string prompt_format such as llama2-chat.")
+        completion = self.submit(self.engine.render_chat(messages), params, doomed=doomed if stream else None, time_limit=time_limit)
+        for choice in completion['choices']:
+            choice['message'] = {'role': 'assistant', 'content': choice.pop('text')}
+        return completion
+
+    def submit(self, prompt, params, doomed=None, time_limit=30):
+        future = Future()
+        request_id = str(next(self.request_ids))
+        self.pending.put(('add', request_id, prompt, params, doomed, future))
+        try:
+            return future.result(timeout=time_limit)
+        except FutureTimeoutError:
+            self.pending.put(('abort', request_id, None, None, None, None))
+            raise TimeoutException("Timed out!")
+
+    def loop(self):
+        while True:
+            # block for new requests only when the engine has nothing to do
+            pending = []
+            try:
+                pending.append(self.pending.get(block=not self.engine.has_unfinished_requests()))
+                while True:
+                    pending.append(self.pending.get_nowait())
+            except queue.Empty:
+                pass
+            for action, request_id, prompt, params, doomed, future in pending:
+                if action == 'add':
+                    self.requests[request_id] = (future, doomed, params.get('max_tokens', None) or 16, {})
+                    self.engine.add_request(request_id, prompt, params)
+                elif request_id in self.requests:
+                    self.engine.abort_request(request_id)
+                    del self.requests[request_id]
+            if not self.engine.has_unfinished_requests():
+                continue
+            try:
+                outputs = self.engine.step()
+            except Exception as e:
+                # fail everything in flight rather than leaving callers waiting for their time limit
+                logging.warning(f"In-process engine step failed: {e}")
+                for request_id, (future, _, _, _) in self.requests.items():
+                    self.engine.abort_request(request_id)
+                    future.set_exception(e)
+                self.requests = {}
+                continue
+            for request_id, texts, finish_reasons, logprobs, usage in outputs:
+                if request_id not in self.requests:
+                    continue
+                future, doomed, max_tokens, doomed_candidates = self.requests[request_id]
+                engine_finished = [finish_reason is not None for finish_reason in finish_reasons]
+                if doomed is not None:
+                    # as when streaming over http, doomed candidates keep the text they had when they were doomed,
+                    # and the request stops once every candidate is finished or doomed
+                    for i in range(len(texts)):
+                        if i not in doomed_candidates and finish_reasons[i] is None and doomed(texts[i]):
+                            doomed_candidates[i] = (texts[i], logprobs[i])
+                    for i, (text, candidate_logprobs) in doomed_candidates.items():
+                        texts[i], logprobs[i], finish_reasons[i] = text, candidate_logprobs, 'doomed'
+                if all([finish_reason is not None for finish_reason in finish_reasons]):
+                    self.engine.abort_request(request_id) # no-op if the engine already finished it
+                    del self.requests[request_id]
+                    # doomed candidates the engine hadn't finished were cut off; an upper bound, as over http
+                    if len(doomed_candidates) > 0:
+                        usage['tokens_saved'] = sum([max(0, max_tokens - len(logprobs[i]['tokens'])) for i in doomed_candidates if not engine_finished[i]])
+                    future.set_result(make_completion(texts, finish_reasons, logprobs=logprobs, usage=usage))
+
+
+ENGINES = {} # server_type -> engine class, for InProcessBackend
+
+
+def register_engine(server_type):
+    def register(engine_class):
+        ENGINES[server_type] = engine_class
+        return engine_class
+    return register
+
+
+@register_engine('vllm-engine')
+class VLLMEngine:
+    # vllm's LLMEngine for the configured model, on this process's gpus
+    def __init__(self, server_config):
+        from vllm import EngineArgs, LLMEngine, SamplingParams
+        self.sampling_params_class = SamplingParams
+        logging.info(f"Loading vllm engine for {server_config['engine']} with {server_config['tensor_parallel_size']} GPUs...")
+        self.engine = LLMEngine.from_engine_args(EngineArgs(model=server_config['engine'], tensor_parallel_size=server_config['tensor_parallel_size']))
+        self.tokenizer = self.engine.tokenizer
+        self.warned_logit_bias = False
+
+    def add_request(self, request_id, prompt, params):
+        if 'logit_bias' in params and not self.warned_logit_bias:
+            logging.warning(f"Logit bias is not supported for vllm engine.")
+            self.warned_logit_bias = True
+        sampling_params = self.sampling_params_class(**{key: value for key, value in params.items() if key in ['n', 'max_tokens', 'temperature', 'top_p', 'frequency_penalty', 'presence_penalty', 'stop', 'logprobs']})
+        self.engine.add_request(request_id, prompt, sampling_params)
+
+    def abort_request(self, request_id):
+        self.engine.abort_request(request_id)
+
+    def has_unfinished_requests(self):
+        return self.engine.has_unfinished_requests()
+
+    def step(self):
+        outputs = []
+        for request_output in self.engine.step():
+            candidates = sorted(request_output.outputs, key=lambda candidate: candidate.index)
+            logprobs = []
+            for candidate in candidates:
+                tokens = [self.tokenizer.decode([token_id]) for token_id in candidate.token_ids]
+                # vllm gives {token id: logprob} per position; the scorers expect openai's {token string: logprob}
+                top_logprobs = [{self.tokenizer.decode([token_id]): logprob for token_id, logprob in position.items()} for position in (candidate.logprobs or [])]
+                logprobs.append({'tokens': tokens, 'top_logprobs': top_logprobs})
+            usage = {'prompt_tokens': len(request_output.prompt_token_ids), 'completion_tokens': sum([len(candidate.token_ids) for candidate in candidates])}
+            outputs.append((request_output.request_id, [candidate.text for candidate in candidates], [candidate.finish_reason for candidate in candidates], logprobs, usage))
+        return outputs
+
+
+@register_engine('mock')
+class MockEngine:
+    # deterministic stand-in for a model: each candidate is a sequence of words seeded by the prompt and candidate index,
+    # generated one word per step so streaming and early stopping behave as with a real engine. every position's
+    # top_logprobs include yes/no and A/B so the scorers find an answer. needs no gpu, server or model weights.
+    WORDS = ['the', 'night', 'river', 'quietly', 'remembered', 'her', 'old', 'friend', 'walked', 'toward', 'door', 'light',
+             'storm', 'village', 'whispered', 'never', 'again', 'under', 'bright', 'moon', 'letter', 'opened', 'slowly', 'and']
+    ANSWERS = {' Yes': -0.5, ' No': -1.0, ' A': -0.3, ' B': -1.4}
+
+    def __init__(self, server_config):
+        self.requests = {} # request id -> (random generators, texts, tokens, finish_reasons, params, prompt tokens)
+
+    def render_chat(self, messages):
+        return '\n\n'.join([message['content'] for message in messages])
+
+    def add_request(self, request_id, prompt, params):
+        n = params.get('n', None) or 1
+        seeds = [int(hashlib.md5(f'{prompt}\x00{i}'.encode()).hexdigest(), 16) for i in range(n)]
+        self.requests[request_id] = ([random.Random(seed) for seed in seeds], [''] * n, [[] for _ in range(n)], [None] * n, params, len(prompt.split()))
+
+    def abort_request(self, request_id):
+        self.requests.pop(request_id, None)
+
+    def has_unfinished_requests(self):
+        return len(self.requests) > 0
+
+    def step(self):
+        outputs = []
+        for request_id, (generators, texts, tokens, finish_reasons, params, prompt_tokens) in list(self.requests.items()):
+            stop = params.get('stop', None) or []
+            stop = [stop] if isinstance(stop, str) else stop
+            for i, generator in enumerate(generators):
+                if finish_reasons[i] is not None:
+                    continue
+                # end a sentence now and then, and stop early sometimes so not every candidate runs to max_tokens
+                word = generator.choice(self.WORDS) + ('.' if generator.random() < 0.15 else '')
+                tokens[i].append(' ' + word)
+                texts[i] += ' ' + word
+                for stop_sequence in stop:
+                    if stop_sequence in texts[i]:
+                        texts[i] = texts[i][:texts[i].index(stop_sequence)]
+                        finish_reasons[i] = 'stop'
+                if finish_reasons[i] is None and (len(tokens[i]) >= (params.get('max_tokens', None) or 16)):
+                    finish_reasons[i] = 'length'
+                elif finish_reasons[i] is None and generator.random() < 0.02:
+                    finish_reasons[i] = 'stop'
+            top_logprobs = [[{token: -0.1, **self.ANSWERS} for token in candidate_tokens] for candidate_tokens in tokens]
+            logprobs = [{'tokens': list(candidate_tokens), 'top_logprobs': candidate_top_logprobs} for candidate_tokens, candidate_top_logprobs in zip(tokens, top_logprobs)]
+            usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': sum([len(candidate_tokens) for candidate_tokens in tokens])}
+            outputs.append((request_id, list(texts), list(finish_reasons), logprobs, usage))
+            if all([finish_reason is not None for finish_reason in finish_reasons]):
+                del self.requests[request_id]
+        return outputs
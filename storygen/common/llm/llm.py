@@ -1,17 +1,21 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 
+from contextlib import contextmanager
+import contextvars
 import logging
-import os
+import threading
 
 import openai
 
+from storygen.common.llm.backends import get_backend
+from storygen.common.llm.prefix_cache import PrefixCacheStats
+from storygen.common.llm.replay import RequestRecorder
+from storygen.common.llm.scheduler import *
 from storygen.common.server import ServerConfig
+from storygen.common.trace import span
 from storygen.common.util import *
 
 
-models = {} # model string -> model object
-
-
 class SamplingConfig:
     def __init__(self, 
                  server_config,
@@ -24,7 +28,8 @@ class SamplingConfig:
                  stop=None,
                  n=None,
                  logit_bias=None,
-                 logprobs=None):
+                 logprobs=None,
+                 stream=False):
         self.server_config = server_config
         self.prompt_format = prompt_format
         self.max_tokens = max_tokens
@@ -36,6 +41,7 @@ class SamplingConfig:
         self.n = n
         self.logit_bias = logit_bias
         self.logprobs = logprobs
+        self.stream = stream # handled by LLMClient rather than passed through in dict()
     
     @staticmethod
     def from_config(config):
@@ -50,7 +56,8 @@ class SamplingConfig:
             stop=config.get('stop', None),
             n=config.get('n', None),
             logit_bias=config.get('logit_bias', None),
-            logprobs=config.get('logprobs', None)
+            logprobs=config.get('logprobs', None),
+            stream=config.get('stream', False)
         )
     
     def __getitem__(self, key):
@@ -64,16 +71,93 @@ class SamplingConfig:
         return d
 
 
+class Usage:
+    # running totals of LLM calls and tokens, as reported by the server
+    def __init__(self, calls=0, prompt_tokens=0, completion_tokens=0, tokens_saved=0, tokens_unread=0):
+        self.calls = calls
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        # upper bound on completion tokens not generated because an in-process engine aborted doomed candidates
+        # (max_tokens minus tokens generated, for each candidate cut off)
+        self.tokens_saved = tokens_saved
+        # the same bound for http streams we stopped reading early. closing the stream doesn't reliably abort the
+        # server's request, so these are only reads skipped; the server may still have generated them
+        self.tokens_unread = tokens_unread
+        self.lock = threading.Lock()
+
+    def record(self, completion):
+        usage = completion.get('usage', None) or {}
+        with self.lock:
+            self.calls += 1
+            self.prompt_tokens += usage.get('prompt_tokens', 0)
+            self.completion_tokens += usage.get('completion_tokens', 0)
+            self.tokens_saved += usage.get('tokens_saved', 0)
+            self.tokens_unread += usage.get('tokens_unread', 0)
+
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    def snapshot(self):
+        with self.lock:
+            return Usage(self.calls, self.prompt_tokens, self.completion_tokens, self.tokens_saved, self.tokens_unread)
+
+    def __sub__(self, other):
+        return Usage(self.calls - other.calls, self.prompt_tokens - other.prompt_tokens, self.completion_tokens - other.completion_tokens, self.tokens_saved - other.tokens_saved, self.tokens_unread - other.tokens_unread)
+
+    def __str__(self):
+        usage_str = f'{self.calls} calls, {self.prompt_tokens} prompt tokens, {self.completion_tokens} completion tokens'
+        if self.tokens_saved > 0:
+            usage_str += f' (up to {self.tokens_saved} completion tokens saved by aborting doomed candidates)'
+        if self.tokens_unread > 0:
+            usage_str += f' (up to {self.tokens_unread} completion tokens left unread by stopping streams early; the server may still have generated them)'
+        return usage_str
+
+
+# extra Usage objects that requests made in this context are also recorded to, e.g. one per story
+usage_trackers = contextvars.ContextVar('usage_trackers', default=())
+
+
+@contextmanager
+def track_usage(usage):
+    # record the usage of requests made in this context (including worker threads started by concurrent_map) to usage
+    token = usage_trackers.set(usage_trackers.get() + (usage,))
+    try:
+        yield usage
+    finally:
+        usage_trackers.reset(token)
+
+
 class LLMClient:
-    def __init__(self):
-        self.warned = {'vllm_logit_bias': False}
+    def __init__(self, max_in_flight=None, requests_per_minute=None, tokens_per_minute=None, track_prefix_cache=False, record_path=None):
+        self.usage = Usage()
+        # cap on concurrent requests across all threads using this client
+        self.in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight is not None else None
+        # openai rate limits apply per model, so each engine gets its own scheduler with these limits
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.schedulers = {}
+        self.schedulers_lock = threading.Lock()
+        # estimated prefix cache hits per stage, from the stage= kwarg of each request
+        self.prefix_stats = PrefixCacheStats() if track_prefix_cache else None
+        # log of every request made, for replaying the load against other servers (see replay.py in scripts/)
+        self.recorder = RequestRecorder(record_path) if record_path is not None else None
 
-    def call_with_retry(self, prompt_builder, sampling_config, postprocessor=None, filter=lambda s: len(s.strip()) > 0, max_attempts=5, **kwargs):
-        for _ in range(max_attempts):
+    def call_with_retry(self, prompt_builder, sampling_config, postprocessor=None, filter=lambda s: len(s.strip()) > 0, max_attempts=5, max_rate_limit_retries=50, **kwargs):
+        attempt, rate_limit_retries = 0, 0
+        while attempt < max_attempts:
             try:
                 completions, full_completion_object = self(prompt_builder, sampling_config, **kwargs)
+            except openai.error.RateLimitError:
+                # the scheduler has already paused for as long as the server asked, so this isn't a failed attempt
+                # unless we've been throttled for a very long time
+                rate_limit_retries += 1
+                if rate_limit_retries > max_rate_limit_retries:
+                    attempt += 1
+                continue
             except:
+                attempt += 1
                 continue
+            attempt += 1
             if postprocessor is not None:
                 completions = postprocessor(completions, full_completion_object=full_completion_object)
             completions = [c for c in completions if filter(c)]
@@ -85,43 +169,89 @@ class LLMClient:
         logging.error(f"Failed to get a valid completion after {max_attempts} attempts.")
         raise RuntimeError(f"Failed to get a valid completion after {max_attempts} attempts.")
     
-    def __call__(self, prompt_builder, sampling_config, **kwargs):
-        if sampling_config.server_config['server_type'] == 'openai':
-            openai.api_key = os.environ['OPENAI_API_KEY']
-            openai.api_base = 'https://api.openai.com/v1'
-        elif sampling_config.server_config['server_type'] == 'vllm':
-            openai.api_key = "EMPTY"
-            openai.api_base = sampling_config.server_config['host'] + ':' + str(sampling_config.server_config['port']) + '/v1'
-            if 'logit_bias' in sampling_config.dict():
-                if not self.warned['vllm_logit_bias']:
-                    logging.warning(f"Logit bias is not supported for vllm server.")
-                    self.warned['vllm_logit_bias'] = True
-        else:
-            raise NotImplementedError(f"Engine type {self.sampling_config.server_config['server_type']} not implemented.")
-        
+    def scheduler(self, sampling_config):
+        if sampling_config.server_config['server_type'] != 'openai':
+            return None
+        with self.schedulers_lock:
+            if sampling_config.server_config.engine not in self.schedulers:
+                self.schedulers[sampling_config.server_config.engine] = RequestScheduler(self.requests_per_minute, self.tokens_per_minute)
+            return self.schedulers[sampling_config.server_config.engine]
+
+    def __call__(self, prompt_builder, sampling_config, priority='normal', **kwargs):
+        if self.recorder is None:
+            return self._scheduled_call(prompt_builder, sampling_config, priority=priority, **kwargs)
+        # recorded from when the request was made, so client-side waits count as server time rather than think time on replay
+        with self.recorder.request(prompt_builder.render_for_llm_format(sampling_config.prompt_format), sampling_config, kwargs.get('stage', 'other')) as record:
+            result = self._scheduled_call(prompt_builder, sampling_config, priority=priority, **kwargs)
+            usage = result[1].get('usage', None) or {}
+            record['prompt_tokens'], record['completion_tokens'] = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+            return result
+
+    def _scheduled_call(self, prompt_builder, sampling_config, priority='normal', **kwargs):
+        # wait for rate-limit admission before taking an in-flight slot, so queued low-priority requests don't hold slots
+        scheduler = self.scheduler(sampling_config)
+        if scheduler is not None:
+            prompt = prompt_builder.render_for_llm_format(sampling_config.prompt_format)
+            with span('rate_limit_wait', priority=priority):
+                scheduler.acquire(estimate_prompt_tokens(prompt) + (sampling_config.max_tokens or 16) * (sampling_config.n or 1), priority=priority)
+        try:
+            if self.in_flight is None:
+                with span('llm_request', stage=kwargs.get('stage', 'other')):
+                    result = self._call(prompt_builder, sampling_config, **kwargs)
+            else:
+                with span('in_flight_wait'):
+                    self.in_flight.acquire()
+                try:
+                    with span('llm_request', stage=kwargs.get('stage', 'other')):
+                        result = self._call(prompt_builder, sampling_config, **kwargs)
+                finally:
+                    self.in_flight.release()
+        except openai.error.RateLimitError as e:
+            if scheduler is not None:
+                scheduler.rate_limited(retry_after_seconds(e))
+            raise
+        if scheduler is not None:
+            scheduler.succeeded()
+        return result
+
+    def _call(self, prompt_builder, sampling_config, **kwargs):
+        backend = get_backend(sampling_config.server_config)
         prompt = prompt_builder.render_for_llm_format(sampling_config.prompt_format)
         logging.debug(f"Prompt: {prompt}")
 
+        backend_kwargs = {'stream': sampling_config.stream, 'doomed': kwargs.get('doomed', None), 'time_limit': kwargs.get('time_limit', 30)}
         if sampling_config['prompt_format'] == 'openai-chat':
-            with time_limit(kwargs.get('time_limit', 30)):
-                completion = openai.ChatCompletion.create(messages=prompt, **sampling_config.dict())
-            logging.debug(f"Completion: {completion.choices[0].message['content']}")
-            texts = [c.message['content'] for c in completion.choices]
+            completion = backend.chat(prompt, sampling_config.dict(), **backend_kwargs)
+            logging.debug(f"Completion: {completion['choices'][0]['message']['content']}")
+            texts = [c['message']['content'] for c in completion['choices']]
             # strip response prefix
             if prompt_builder.response_prefix is not None:
                 for i, text in enumerate(texts):
                     if text.startswith(prompt_builder.response_prefix.format()):
                         texts[i] = text[len(prompt_builder.response_prefix.format()):]
         else:
-            params = sampling_config.dict()
-            if 'logit_bias' in params:
-                del params['logit_bias'] # vllm doesn't yet support logit bias
-            with time_limit(kwargs.get('time_limit', 30)):
-                completion = openai.Completion.create(prompt=prompt, **params) 
-            logging.debug(f"Completion: {completion.choices[0].text}")
-            texts = [c.text for c in completion.choices]
+            completion = backend.complete(prompt, sampling_config.dict(), **backend_kwargs)
+            logging.debug(f"Completion: {completion['choices'][0]['text']}")
+            texts = [c['text'] for c in completion['choices']]
+        self.record_usage(sampling_config, prompt, completion, stage=kwargs.get('stage', 'other'))
         
         if prompt_builder.output_prefix is not None:
             for i, text in enumerate(texts):
                 texts[i] = prompt_builder.output_prefix.rstrip() + ' ' + text.lstrip()
-        return texts, completion
\ No newline at end of file
+        return texts, completion
+
+    def record_usage(self, sampling_config, prompt, completion, stage='other'):
+        self.usage.record(completion)
+        for usage in usage_trackers.get():
+            usage.record(completion)
+        if self.prefix_stats is not None:
+            server = (sampling_config.server_config.host, sampling_config.server_config.port, sampling_config.server_config.engine)
+            self.prefix_stats.record(server, stage, prompt, (completion.get('usage', None) or {}).get('prompt_tokens', 0))
+
+
+def retry_after_seconds(error):
+    # the Retry-After header of a rate-limit response, if it has a usable one
+    try:
+        return float(error.headers.get('retry-after'))
+    except:
+        return None
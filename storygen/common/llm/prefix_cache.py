@@ -0,0 +1,59 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import bisect
+from collections import deque
+import threading
+
+
+def common_prefix_length(a, b):
+    # binary search on slice equality, so the character comparisons run in C
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+class PrefixCacheStats:
+    # estimates how much prefill a server-side prefix cache (e.g. vllm's prefix caching) could skip: for each request,
+    # the longest prefix its prompt shares with any of the last `window` prompts sent to the same server. measured in
+    # characters, then converted to tokens using the prompt token count the server reports. tracked per stage
+    def __init__(self, window=64):
+        self.window = window
+        self.lock = threading.Lock()
+        self.recent = {} # server -> (deque of recent prompts in arrival order, sorted list of the same prompts)
+        self.stages = {} # stage -> [requests, prompt chars, shared prefix chars, prompt tokens, estimated cached tokens]
+
+    def record(self, server, stage, prompt, prompt_tokens=0):
+        if isinstance(prompt, list): # chat messages
+            prompt = ''.join([message['role'] + ': ' + message['content'] + '\n' for message in prompt])
+        with self.lock:
+            arrival_order, sorted_prompts = self.recent.setdefault(server, (deque(), []))
+            # the longest common prefix with any string in a set is with one of its neighbors in sorted order
+            i = bisect.bisect_left(sorted_prompts, prompt)
+            shared = max([common_prefix_length(prompt, sorted_prompts[j]) for j in [i - 1, i] if 0 <= j < len(sorted_prompts)], default=0)
+            arrival_order.append(prompt)
+            sorted_prompts.insert(i, prompt)
+            if len(arrival_order) > self.window:
+                oldest = arrival_order.popleft()
+                del sorted_prompts[bisect.bisect_left(sorted_prompts, oldest)]
+            stats = self.stages.setdefault(stage, [0, 0, 0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += len(prompt)
+            stats[2] += shared
+            stats[3] += prompt_tokens
+            stats[4] += prompt_tokens * shared / max(len(prompt), 1)
+
+    def hit_rate(self, stage):
+        stats = self.stages.get(stage, [0, 0, 0, 0, 0.0])
+        return stats[2] / stats[1] if stats[1] > 0 else 0
+
+    def __str__(self):
+        with self.lock:
+            lines = []
+            for stage, (requests, prompt_chars, shared_chars, prompt_tokens, cached_tokens) in sorted(self.stages.items()):
+                lines.append(f'{stage}: {requests} requests, {100 * shared_chars / max(prompt_chars, 1):.1f}% of prompt shared with a recent request (~{cached_tokens:.0f} of {prompt_tokens} prompt tokens)')
+            return '\n'.join(lines) if len(lines) > 0 else 'no requests'
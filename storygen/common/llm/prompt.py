@@ -81,6 +81,17 @@ def load_prompts(path):
     return prompts
 
 
+def overlay_prompts(prompts, overrides):
+    # copy of prompts with the (possibly nested) prompts in overrides replacing those with the same keys
+    prompts = dict(prompts)
+    for key in overrides:
+        if isinstance(overrides[key], dict) and isinstance(prompts.get(key, None), dict):
+            prompts[key] = overlay_prompts(prompts[key], overrides[key])
+        else:
+            prompts[key] = overrides[key]
+    return prompts
+
+
 def _create_prompt_templates(prompts):
     # recursively traverse prompts until you find a dict containing "instruction" key, and make TemplatePromptBuilder objects
     for key in prompts:
@@ -0,0 +1,234 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+from contextlib import contextmanager
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from storygen.common.llm.backends import get_backend
+from storygen.common.util import *
+
+
+# record the requests a run issues, then replay them against a target server at a scaled rate or concurrency to see
+# what throughput and latency it sustains. each recorded request is a jsonl record:
+#   {'type': 'request', 'id', 'after': [ids], 'stage', 'server_type', 'engine', 'prompt_format', 'prompt', 'params',
+#    'start', 'end', 'status', 'prompt_tokens', 'completion_tokens'}
+# with start/end in seconds since recording began. 'after' lists the requests that had to finish before this one was
+# issued: the previous request in the same chain of calls (carried into concurrent_map workers by the context), and
+# the most recent request to finish anywhere, which stands in for joins after a concurrent fan-out.
+
+last_request = contextvars.ContextVar('last_recorded_request', default=None)
+
+
+class RequestRecorder:
+    # records one run: the file is truncated when recording starts, since request ids restart from 0 in every run
+    def __init__(self, path):
+        self.path = path
+        open(path, 'w').close()
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+        self.last_finished = None # (end, id) of the latest request to finish
+        self.start_time = time.perf_counter()
+
+    def now(self):
+        return time.perf_counter() - self.start_time
+
+    @contextmanager
+    def request(self, prompt, sampling_config, stage):
+        # yields the record; the caller fills in prompt_tokens and completion_tokens if it gets a completion
+        with self.lock:
+            request_id = next(self.request_ids)
+            after = {last_request.get(), self.last_finished[1] if self.last_finished is not None else None} - {None}
+        record = {
+            'type': 'request',
+            'id': request_id,
+            'after': sorted(after),
+            'stage': stage,
+            'server_type': sampling_config.server_config.server_type,
+            'engine': sampling_config.server_config.engine,
+            'prompt_format': sampling_config.prompt_format,
+            'prompt': prompt,
+            'params': sampling_config.dict(),
+            'start': self.now(),
+            'status': 'error',
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+        }
+        try:
+            yield record
+            record['status'] = 'ok'
+        finally:
+            record['end'] = self.now()
+            with self.lock:
+                if self.last_finished is None or record['end'] > self.last_finished[0]:
+                    self.last_finished = (record['end'], request_id)
+                append_jsonl(self.path, record)
+            last_request.set(request_id)
+
+
+def load_trace(path):
+    records = [record for record in read_jsonl(path, repair=False) if record['type'] == 'request']
+    # replay waits on each request's dependencies by id, so a trace it can't resolve would never finish
+    request_ids = set([record['id'] for record in records])
+    if len(request_ids) < len(records):
+        raise ValueError(f"Trace {path} has duplicate request ids; record each run to its own file")
+    unknown_ids = set([dependency for record in records for dependency in record['after']]) - request_ids
+    if len(unknown_ids) > 0:
+        raise ValueError(f"Trace {path} has requests waiting on unrecorded requests {sorted(unknown_ids)[:10]}")
+    logging.info(f"Loaded {len(records)} recorded requests from {path} spanning {max([record['end'] for record in records], default=0):.1f}s")
+    return records
+
+
+def replay(records, server_config, rate_scale=1.0, copies=1, max_in_flight=None, respect_dependencies=True, time_limit=120):
+    # re-issue the recorded requests to server_config, returning one result per request issued.
+    # with respect_dependencies, a request is issued once the requests it waited for have finished in the replay, plus
+    # its original think time after them divided by rate_scale, so a slow server slows the replayed run as it would a
+    # real one. otherwise requests are issued open-loop at their original start times divided by rate_scale.
+    # copies replays that many independent copies of the trace at once, like running that many stories concurrently
+    backend = get_backend(server_config)
+    records_by_id = {record['id']: record for record in records}
+    dependents = {}
+    for record in records:
+        for dependency in record['after']:
+            dependents.setdefault(dependency, []).append(record['id'])
+
+    lock = threading.Condition()
+    ready = [] # heap of (release time, copy, id)
+    remaining = {} # (copy, id) -> number of unfinished dependencies
+    finished = {} # (copy, id) -> replay finish time
+    results = []
+    in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight is not None else None
+    start_time = time.perf_counter()
+
+    def release(copy, request_id):
+        # called with the lock held, once every dependency of the request has finished
+        record = records_by_id[request_id]
+        if respect_dependencies and len(record['after']) > 0:
+            release_time = max([finished[(copy, dependency)] + max(0, record['start'] - records_by_id[dependency]['end']) / rate_scale for dependency in record['after']])
+        else:
+            release_time = record['start'] / rate_scale
+        heapq.heappush(ready, (release_time, copy, request_id))
+        lock.notify()
+
+    def issue(release_time, copy, request_id):
+        record = records_by_id[request_id]
+        params = {**record['params'], 'model': server_config.engine}
+        result = {'id': request_id, 'copy': copy, 'stage': record['stage'], 'scheduled': release_time, 'status': 'ok', 'completion_tokens': 0}
+        try:
+            result['issued'] = time.perf_counter() - start_time
+            if record['prompt_format'] == 'openai-chat':
+                completion = backend.chat(record['prompt'], params, time_limit=time_limit)
+            else:
+                completion = backend.complete(record['prompt'], params, time_limit=time_limit)
+            result['completion_tokens'] = (completion.get('usage', None) or {}).get('completion_tokens', 0)
+        except Exception as e:
+            result['status'] = 'error'
+            logging.debug(f"Replayed request {request_id} failed: {e}")
+        finally:
+            if in_flight is not None:
+                in_flight.release()
+            result['finished'] = time.perf_counter() - start_time
+            result['latency'] = result['finished'] - result['issued']
+            with lock:
+                results.append(result)
+                finished[(copy, request_id)] = result['finished']
+                for dependent in dependents.get(request_id, []):
+                    remaining[(copy, dependent)] -= 1
+                    if remaining[(copy, dependent)] == 0:
+                        release(copy, dependent)
+                lock.notify()
+
+    total = len(records) * copies
+    with ThreadPoolExecutor(max_workers=max_in_flight or 256) as executor:
+        with lock:
+            for copy in range(copies):
+                for record in records:
+                    if respect_dependencies:
+                        remaining[(copy, record['id'])] = len(record['after'])
+                        if len(record['after']) == 0:
+                            release(copy, record['id'])
+                    else:
+                        release(copy, record['id'])
+            num_issued = 0
+            while num_issued < total:
+                if len(ready) == 0:
+                    lock.wait()
+                    continue
+                delay = ready[0][0] - (time.perf_counter() - start_time)
+                if delay > 0:
+                    lock.wait(timeout=delay)
+                    continue
+                release_time, copy, request_id = heapq.heappop(ready)
+                num_issued += 1
+                # wait for an in-flight slot outside the lock, so finishing requests can release their dependents
+                lock.release()
+                try:
+                    if in_flight is not None:
+                        in_flight.acquire()
+                    executor.submit(issue, release_time, copy, request_id)
+                finally:
+                    lock.acquire()
+    return results
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def summarize_replay(results, rate_scale=1.0, copies=1):
+    ok = [result for result in results if result['status'] == 'ok']
+    duration = max([result['finished'] for result in results], default=0)
+    latencies = [result['latency'] for result in ok]
+    # how far behind schedule requests were issued; grows once the client's in-flight cap is the bottleneck
+    issue_delays = [result['issued'] - result['scheduled'] for result in results]
+    by_stage = {}
+    for stage in sorted(set([result['stage'] for result in ok])):
+        stage_latencies = [result['latency'] for result in ok if result['stage'] == stage]
+        by_stage[stage] = {'requests': len(stage_latencies), 'p50': percentile(stage_latencies, 50), 'p90': percentile(stage_latencies, 90)}
+    return {
+        'rate_scale': rate_scale,
+        'copies': copies,
+        'requests': len(results),
+        'errors': len(results) - len(ok),
+        'seconds': duration,
+        'requests_per_second': len(ok) / duration if duration > 0 else 0,
+        'completion_tokens_per_second': sum([result['completion_tokens'] for result in ok]) / duration if duration > 0 else 0,
+        'latency': {'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90), 'p99': percentile(latencies, 99)},
+        'issue_delay': {'p50': percentile(issue_delays, 50), 'p99': percentile(issue_delays, 99)},
+        'by_stage': by_stage,
+    }
+
+
+def find_saturation(summaries, min_gain=0.5, max_latency_growth=2.0):
+    # given summaries of replays at increasing load, the first one where the server stopped keeping up: throughput
+    # grew by less than min_gain of the added load, or median latency grew past max_latency_growth times the lightest
+    # load's. returns None if it kept up throughout
+    summaries = sorted(summaries, key=lambda summary: summary['rate_scale'] * summary['copies'])
+    for previous, summary in zip(summaries, summaries[1:]):
+        load_growth = (summary['rate_scale'] * summary['copies']) / (previous['rate_scale'] * previous['copies']) - 1
+        throughput_growth = summary['completion_tokens_per_second'] / max(previous['completion_tokens_per_second'], 1e-8) - 1
+        latency_growth = (summary['latency']['p50'] or 0) / max(summaries[0]['latency']['p50'] or 0, 1e-8)
+        if throughput_growth < min_gain * load_growth or latency_growth > max_latency_growth or summary['errors'] > 0:
+            return summary
+    return None
+
+
+def format_summary(summary):
+    latency, issue_delay = summary['latency'], summary['issue_delay']
+    format_seconds = lambda seconds: f'{seconds:.2f}s' if seconds is not None else '-'
+    lines = [f"rate x{summary['rate_scale']}, {summary['copies']} copies: {summary['requests']} requests ({summary['errors']} errors) in {summary['seconds']:.1f}s, "
+             f"{summary['requests_per_second']:.2f} requests/s, {summary['completion_tokens_per_second']:.1f} completion tokens/s; "
+             f"latency p50 {format_seconds(latency['p50'])} p90 {format_seconds(latency['p90'])} p99 {format_seconds(latency['p99'])}; "
+             f"issue delay p50 {format_seconds(issue_delay['p50'])} p99 {format_seconds(issue_delay['p99'])}"]
+    for stage, stage_summary in summary['by_stage'].items():
+        lines.append(f"  {stage}: {stage_summary['requests']} requests, latency p50 {format_seconds(stage_summary['p50'])} p90 {format_seconds(stage_summary['p90'])}")
+    return '\n'.join(lines)
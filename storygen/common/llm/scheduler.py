@@ -0,0 +1,103 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+# requests on a story's critical path (passage generation) go ahead of summaries, which go ahead of scoring
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
+
+class TokenBucket:
+    # refills continuously at per_minute / 60 per second, holding up to one minute's worth
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = per_minute
+        self.last_refill = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def wait_time(self, amount, now):
+        self.refill(now)
+        # a single request larger than the bucket would never fit; let it through once the bucket is full
+        return max(0, min(amount, self.capacity) - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= amount
+
+
+class RequestScheduler:
+    # admits requests to one rate-limited model under requests-per-minute and tokens-per-minute limits,
+    # highest priority first (FIFO within a priority), and pauses all admissions after a rate-limit response.
+    # tokens are the estimated prompt tokens plus max_tokens per completion, which is what providers count
+    # against the limit when the request arrives
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_backoff=60):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute is not None else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute is not None else None
+        self.max_backoff = max_backoff
+        self.condition = threading.Condition()
+        self.waiting = [] # heap of (priority, arrival) tickets
+        self.counter = itertools.count()
+        self.paused_until = 0
+        self.consecutive_rate_limits = 0
+
+    def _wait_time(self, tokens):
+        now = time.monotonic()
+        wait_time = self.paused_until - now
+        if self.request_bucket is not None:
+            wait_time = max(wait_time, self.request_bucket.wait_time(1, now))
+        if self.token_bucket is not None:
+            wait_time = max(wait_time, self.token_bucket.wait_time(tokens, now))
+        return wait_time
+
+    def acquire(self, tokens, priority='normal'):
+        # blocks until this request may be sent. only the highest-priority waiter is ever admitted, so a
+        # steady stream of low-priority requests can't starve passage generation
+        ticket = (PRIORITIES[priority], next(self.counter))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    wait_time = self._wait_time(tokens) if self.waiting[0] == ticket else None
+                    if wait_time is not None and wait_time <= 0:
+                        break
+                    self.condition.wait(wait_time)
+                if self.request_bucket is not None:
+                    self.request_bucket.take(1)
+                if self.token_bucket is not None:
+                    self.token_bucket.take(tokens)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def succeeded(self):
+        with self.condition:
+            self.consecutive_rate_limits = 0
+
+    def rate_limited(self, retry_after=None):
+        # pause admissions for retry_after seconds if the server gave one, else back off exponentially
+        with self.condition:
+            self.consecutive_rate_limits += 1
+            if retry_after is None:
+                retry_after = min(self.max_backoff, 2 ** (self.consecutive_rate_limits - 1))
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            # the provider's view of our usage is ahead of ours, so don't let a full bucket burst straight back in
+            for bucket in [self.request_bucket, self.token_bucket]:
+                if bucket is not None:
+                    bucket.level = min(bucket.level, 0)
+            self.condition.notify_all()
+        logging.warning(f"Rate limited; pausing requests for {retry_after:.1f}s")
+
+
+def estimate_prompt_tokens(prompt):
+    # rough count for rate limiting (about 4 characters per token), without needing the provider's tokenizer
+    if isinstance(prompt, list): # chat messages
+        return sum([len(message['content']) // 4 + 4 for message in prompt])
+    return len(prompt) // 4
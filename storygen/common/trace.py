@@ -0,0 +1,121 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+
+# nested timing spans, exported in the chrome trace event format (viewable in chrome://tracing or ui.perfetto.dev).
+# tracing is off unless start_tracing() is called; when off, span() returns a shared no-op context manager, so the
+# cost is one global lookup per span.
+
+tracer = None
+current_span = contextvars.ContextVar('current_span', default=None) # carried into worker threads by concurrent_map
+
+
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.span_ids = itertools.count(1)
+        self.thread_ids = {}
+        self.start_time = time.perf_counter()
+
+    def timestamp(self):
+        return (time.perf_counter() - self.start_time) * 1e6 # microseconds
+
+    def thread_id(self):
+        # small stable ids rather than OS thread idents, so the viewer's thread lanes are readable
+        with self.lock:
+            return self.thread_ids.setdefault(threading.get_ident(), len(self.thread_ids))
+
+    def add(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def save(self, path):
+        with self.lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+        with open(path + '.tmp', 'w') as f:
+            json.dump(trace, f)
+        os.replace(path + '.tmp', path)
+
+
+class Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.span_id = next(tracer.span_ids)
+        parent = current_span.get()
+        self.args['span_id'] = self.span_id
+        if parent is not None:
+            self.args['parent_id'] = parent.span_id
+        self.token = current_span.set(self)
+        self.start = tracer.timestamp()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = tracer.timestamp()
+        current_span.reset(self.token)
+        if exc_type is not None:
+            self.args['error'] = repr(exc_value)
+        tracer.add({
+            'name': self.name, 
+            'ph': 'X', 
+            'ts': self.start, 
+            'dur': end - self.start, 
+            'pid': os.getpid(), 
+            'tid': tracer.thread_id(), 
+            'args': {key: value if isinstance(value, (int, float, bool, str)) or value is None else str(value) for key, value in self.args.items()}
+        })
+        return False
+
+
+class NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def span(name, **args):
+    if tracer is None:
+        return NOOP_SPAN
+    return Span(name, args)
+
+
+def traced(name=None):
+    # decorator putting each call of the function in a span
+    def decorator(fn):
+        span_name = name if name is not None else fn.__name__
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return fn(*args, **kwargs)
+            with Span(span_name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_tracing():
+    global tracer
+    tracer = Tracer()
+
+
+def stop_tracing(path=None):
+    # stop recording, and save what was recorded to path if given
+    global tracer
+    if tracer is not None and path is not None:
+        tracer.save(path)
+    tracer = None
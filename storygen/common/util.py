@@ -1,9 +1,12 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 
 from contextlib import contextmanager
+import json
 import logging
+import os
 import re
 import signal
+import threading
 
 
 import roman
@@ -29,6 +32,10 @@ class TimeoutException(Exception): pass
 
 @contextmanager
 def time_limit(seconds):
+    if threading.current_thread() is not threading.main_thread():
+        # signals can only be handled on the main thread; callers in worker threads rely on request timeouts instead
+        yield
+        return
     def signal_handler(signum, frame):
         raise TimeoutException("Timed out!")
     signal.signal(signal.SIGALRM, signal_handler)
@@ -39,6 +46,37 @@ def time_limit(seconds):
         signal.alarm(0)
 
 
+def append_jsonl(path, record):
+    # one write + fsync per record, so a crash can at worst leave a torn final line (dropped by read_jsonl)
+    line = (json.dumps(record) + '\n').encode('utf-8')
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_jsonl(path, repair=True):
+    # read records written by append_jsonl. a torn final line from a crash mid-write is ignored,
+    # and if repair is set it's truncated away so that later appends start on a clean line
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as f:
+        data = f.read()
+    complete_length = data.rfind(b'\n') + 1
+    if complete_length < len(data):
+        logging.warning(f"Ignoring torn final record in {path}")
+        if repair:
+            with open(path, 'r+b') as f:
+                f.truncate(complete_length)
+    records = []
+    for line in data[:complete_length].decode('utf-8').split('\n'):
+        if line.strip() != '':
+            records.append(json.loads(line))
+    return records
+
+
 def num_to_char(num, newline=False):
     if num > 26:
         return num_to_char(num // 26) + num_to_char(num % 26)
@@ -75,6 +113,59 @@ class Filter:
         return Filter(lambda s: self.filter_func(s) and other.filter_func(s))
 
 
+def normalize_text(s):
+    # lowercase alphanumeric words only, for comparing texts that differ just in case, punctuation or spacing
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', s.lower()).split())
+
+
+class NearDuplicateIndex:
+    # detects near-duplicate texts by jaccard similarity of word n-grams, using an inverted index
+    # so each lookup only compares against texts sharing at least one n-gram
+    def __init__(self, threshold=0.5, ngram=3):
+        self.threshold = threshold
+        self.ngram = ngram
+        self.shingle_sets = []
+        self.index = {}
+
+    def shingles(self, s):
+        words = normalize_text(s).split()
+        if len(words) < self.ngram:
+            return {' '.join(words)}
+        return {' '.join(words[i:i+self.ngram]) for i in range(len(words) - self.ngram + 1)}
+
+    def is_duplicate(self, s):
+        shingles = self.shingles(s)
+        overlaps = {}
+        for shingle in shingles:
+            for i in self.index.get(shingle, []):
+                overlaps[i] = overlaps.get(i, 0) + 1
+        for i, overlap in overlaps.items():
+            if overlap / len(shingles | self.shingle_sets[i]) >= self.threshold:
+                return True
+        return False
+
+    def add(self, s):
+        # returns False without adding if s is a near duplicate of something already in the index
+        if self.is_duplicate(s):
+            return False
+        shingles = self.shingles(s)
+        for shingle in shingles:
+            self.index.setdefault(shingle, []).append(len(self.shingle_sets))
+        self.shingle_sets.append(shingles)
+        return True
+
+    def __len__(self):
+        return len(self.shingle_sets)
+
+
+tokenizer_lock = threading.Lock()
+
+def count_tokens(tokenizer, s):
+    # fast tokenizers can raise "Already borrowed" when used from several threads at once
+    with tokenizer_lock:
+        return len(tokenizer.encode(s))
+
+
 def min_max_tokens_filter(min_tokens, max_tokens, tokenizer_model_string='gpt2', filter_empty=True):
     # the tokenizer model doesn't really matter. we're just counting tokens for filtering purposes
     global tokenizers
@@ -83,7 +174,7 @@ def min_max_tokens_filter(min_tokens, max_tokens, tokenizer_model_string='gpt2',
     else:
         tokenizer = AutoTokenizer.from_pretrained(tokenizer_model_string)
         tokenizers[tokenizer_model_string] = tokenizer
-    filter = Filter(lambda s: min_tokens <= len(tokenizer.encode(s.strip())) <= max_tokens)
+    filter = Filter(lambda s: min_tokens <= count_tokens(tokenizer, s.strip()) <= max_tokens)
     if filter_empty:
         filter = filter + Filter(lambda s: len(s.strip()) > 0)
     return filter
@@ -0,0 +1,86 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import heapq
+import itertools
+import logging
+
+
+def node_path(node):
+    # child indices from the root; sorts nodes in depth-first (story) order
+    return tuple(ancestor.parent.children.index(ancestor) for ancestor in node.ancestors(include_self=True)[1:])
+
+
+def node_span(node):
+    # (start, width) of the fraction of the story covered by this node, assuming siblings split their parent evenly
+    start, width = 0.0, 1.0
+    for ancestor in node.ancestors(include_self=True)[1:]:
+        width /= len(ancestor.parent.children)
+        start += ancestor.parent.children.index(ancestor) * width
+    return start, width
+
+
+EXPANSION_PRIORITIES = {
+    'breadth-first': lambda node: (node.depth(), node_path(node)),
+    'depth-first': lambda node: node_path(node),
+    # the coarsest (widest) nodes first, as a cheap proxy for the vaguest ones
+    'importance': lambda node: (-node_span(node)[1], node_span(node)[0]),
+    # nodes centered earliest in the story first, so the outline is refined roughly left to right
+    'story-position': lambda node: (node_span(node)[0] + node_span(node)[1] / 2, node.depth()),
+}
+
+
+class ExpansionScheduler:
+    # maintains the frontier of expandable outline nodes in a priority queue, updated as nodes are expanded
+    # rather than rescanning the tree, and stops once the plan's call/token budget would be exceeded. start_usage is
+    # the usage snapshot taken when the plan was started, so the budget covers the setting, entities and any earlier
+    # outline attempts too
+    def __init__(self, outline, outline_config, llm_client, start_usage=None):
+        if outline_config['expansion_policy'] not in EXPANSION_PRIORITIES:
+            raise NotImplementedError(f"Expansion policy {outline_config['expansion_policy']} not implemented.")
+        self.outline = outline
+        self.priority = EXPANSION_PRIORITIES[outline_config['expansion_policy']]
+        self.max_depth = outline_config['max_depth']
+        self.budget_calls = outline_config.get('budget_calls', None)
+        self.budget_tokens = outline_config.get('budget_tokens', None)
+        self.usage = llm_client.usage
+        self.expansion_start_usage = self.usage.snapshot()
+        self.start_usage = start_usage if start_usage is not None else self.expansion_start_usage
+        self.num_expansions = 0
+        self.frontier = []
+        self.counter = itertools.count() # tiebreaker, so nodes themselves are never compared
+        for node in outline.depth_first_traverse():
+            if len(node.children) == 0:
+                self.push(node)
+
+    def push(self, node):
+        if node.depth() < self.max_depth:
+            heapq.heappush(self.frontier, (self.priority(node), next(self.counter), node))
+
+    def expanded(self, node):
+        self.num_expansions += 1
+        for child in node.children:
+            self.push(child)
+
+    def within_budget(self):
+        if len(self.outline.children) == 0:
+            return True # always expand the root, so the outline is never empty
+        usage = self.usage.snapshot()
+        spent = usage - self.start_usage
+        spent_expanding = usage - self.expansion_start_usage
+        for budget, used, used_expanding in [(self.budget_calls, spent.calls, spent_expanding.calls), (self.budget_tokens, spent.total_tokens(), spent_expanding.total_tokens())]:
+            # stop if the next expansion would likely go over, based on the average cost of this outline's expansions so far
+            if budget is not None and used + used_expanding / max(self.num_expansions, 1) > budget:
+                logging.info(f"Outline expansion budget reached after {self.num_expansions} expansions ({spent}); stopping with a shallower outline")
+                return False
+        return True
+
+    def pop(self):
+        while len(self.frontier) > 0:
+            if not self.within_budget():
+                break
+            _, _, node = heapq.heappop(self.frontier)
+            # skip stale entries for nodes that were since expanded or dropped by a retry
+            attached = all(ancestor in ancestor.parent.children for ancestor in node.ancestors(include_self=True)[1:])
+            if len(node.children) == 0 and attached:
+                return node
+        raise StopIteration
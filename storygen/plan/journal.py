@@ -0,0 +1,91 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import logging
+import os
+
+from storygen.common.util import *
+from storygen.plan.setting import Setting
+from storygen.plan.entity import *
+from storygen.plan.outline import *
+
+
+class PlanJournal:
+    # append-only journal of completed plan steps (setting, each entity, each outline node's event/scene/entities,
+    # and removals of nodes dropped by outline retries).
+    # every record is written and fsynced as soon as its step finishes, and the plan writer restores from it
+    # on restart, so a crash partway through the outline only loses the step that was in progress.
+    def __init__(self, path, premise):
+        self.path = path
+        self.records = read_jsonl(path)
+        if len(self.records) == 0:
+            self.log('premise', title=premise.title, premise=premise.premise)
+        elif self.records[0]['title'] != premise.title or self.records[0]['premise'] != premise.premise:
+            raise ValueError(f"Plan journal {path} was written for a different premise; delete it to start over.")
+        else:
+            logging.info(f"Resuming plan from journal {path} ({len(self.records)} records)")
+
+    def log(self, record_type, **data):
+        record = {'type': record_type, **data}
+        append_jsonl(self.path, record)
+        self.records.append(record)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.records = []
+
+    def _records_of_type(self, *record_types):
+        return [record for record in self.records if record['type'] in record_types]
+
+    def restore_setting(self, plan):
+        records = self._records_of_type('setting')
+        if len(records) == 0:
+            return False
+        plan.setting = Setting(records[-1]['setting'])
+        return True
+
+    def restore_entities(self, plan):
+        # returns whether more entities should be generated
+        records = self._records_of_type('entity')
+        plan.entity_list = EntityList([Entity(record['name'], record['description']) for record in records])
+        return records[-1]['has_next'] if len(records) > 0 else True
+
+    def restore_outline(self, plan):
+        # rebuild the outline from the journal, dropping any node whose event was never logged
+        self.expanded_node_ids, self.event_has_next = set(), {}
+        self.scene_node_ids, self.entity_node_ids = set(), set()
+        records = self._records_of_type('outline', 'event', 'scene', 'node_entities', 'expanded', 'remove')
+        if len(records) == 0 or records[0]['type'] != 'outline':
+            return False
+        plan.outline = OutlineNode('', None, id=records[0]['id'])
+        nodes = {plan.outline.id: plan.outline}
+        for record in records[1:]:
+            if record['type'] == 'event':
+                parent = nodes[record['parent']]
+                node = OutlineNode(record['text'], parent, id=record['id'])
+                parent.children.append(node)
+                nodes[node.id] = node
+                self.event_has_next[node.id] = record['has_next']
+            elif record['type'] == 'scene':
+                nodes[record['id']].scene = record['scene']
+                self.scene_node_ids.add(record['id'])
+            elif record['type'] == 'node_entities':
+                nodes[record['id']].entities = record['entities']
+                self.entity_node_ids.add(record['id'])
+            elif record['type'] == 'expanded':
+                self.expanded_node_ids.add(record['id'])
+            elif record['type'] == 'remove':
+                # dropped by a retry; its parent needs (re-)expanding
+                node = nodes.pop(record['id'])
+                node.parent.children.remove(node)
+                self.expanded_node_ids.discard(node.parent.id)
+        return True
+
+    def is_expanded(self, node):
+        return node.id in self.expanded_node_ids
+
+    def has_scene(self, node):
+        return node.id in self.scene_node_ids
+
+    def has_entities(self, node):
+        return node.id in self.entity_node_ids
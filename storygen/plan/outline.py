@@ -47,6 +47,12 @@ class OutlineNode(Sequence):
     def __eq__(self, other):
         return self.id == other.id
     
+    def shallow_copy(self):
+        # a copy of this node with its own children list; the children themselves are shared and keep their parent
+        node = OutlineNode(self.text, self.parent, self.scene, self.entities, self.id)
+        node.children = list(self.children)
+        return node
+
     def to_dict(self):
         return {
             'text': self.text,
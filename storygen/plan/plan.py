@@ -27,6 +27,11 @@ class Plan:
         self.setting = setting
         self.entity_list = entity_list
         self.outline = outline
+        self.render_orders = {} # rendering policy -> RenderOrder, cached by the story writer; clear if the outline changes
+    
+    def with_outline(self, outline):
+        # a plan sharing this one's premise, setting and entities but with a different outline, and its own render orders
+        return Plan(self.premise, self.setting, self.entity_list, outline)
     
     def __str__(self):
         return f'{self.premise}\n\nSetting: {self.setting}\n\n\n\nCharacters and Entities:\n\n{self.entity_list}\n\n\n\nOutline:\n\n{self.outline}'
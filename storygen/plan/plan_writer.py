@@ -3,22 +3,64 @@
 from storygen.common.util import *
 from storygen.common.llm.llm import *
 from storygen.premise.premise import Premise
+from storygen.plan.plan import Plan
 from storygen.plan.setting import Setting
 from storygen.plan.entity import *
 from storygen.plan.outline import *
+from storygen.common.trace import span, traced
+from storygen.plan.expansion import ExpansionScheduler, node_path
 
 
-def generate_setting(plan, llm_client, setting_prompt, setting_config):
+def generate_plan(premise, plan_prompts, plan_config, llm_client, journal=None):
+    # setting, entities and outline, retrying entities and the outline up to their max_attempts
+    start_usage = llm_client.usage.snapshot() # the outline budget covers the whole plan, retries included
+    plan = Plan(premise)
+    generate_setting(plan, llm_client, plan_prompts['setting'], plan_config['setting'], journal=journal)
+    logging.info(f'Generated setting: {plan.setting}')
+
+    success = False
+    for i in range(plan_config['entity']['max_attempts']):
+        try:
+            generate_entities(plan, llm_client, plan_prompts['entity'], plan_config['entity'], journal=journal)
+            success = True
+            break
+        except:
+            logging.warning(f'Failed to generate entities, retrying ({i+1}/{plan_config["entity"]["max_attempts"]})')
+    if not success:
+        raise Exception('Failed to generate entities')
+    logging.info(f'Generated entities: {plan.entity_list}')
+
+    success = False
+    for i in range(plan_config['outline']['max_attempts']):
+        # generate_outline already retries failures locally (child, then node, then ancestors); this is the last resort
+        try:
+            generate_outline(plan, llm_client, plan_prompts['outline'], plan_config['outline'], journal=journal, start_usage=start_usage)
+            success = True
+            break
+        except:
+            logging.warning(f'Failed to generate outline, retrying ({i+1}/{plan_config["outline"]["max_attempts"]})')
+    if not success:
+        raise Exception('Failed to generate outline')
+    return plan
+
+
+@traced()
+def generate_setting(plan, llm_client, setting_prompt, setting_config, journal=None):
+    if journal is not None and journal.restore_setting(plan):
+        return plan
     plan.setting = Setting(llm_client.call_with_retry(
         setting_prompt.format(title=plan.premise.title, premise=plan.premise.premise),
         SamplingConfig.from_config(setting_config),
         filter=min_max_tokens_filter(0, setting_config['max_tokens']))[0]
     )
     logging.debug(f"Setting: {plan.setting.setting}")
+    if journal is not None:
+        journal.log('setting', setting=plan.setting.setting)
     return plan
 
 
-def generate_entities(plan, llm_client, entity_prompt, entity_config):
+@traced()
+def generate_entities(plan, llm_client, entity_prompt, entity_config, journal=None):
     def postprocess_name(names, **kwargs):
         return [name.strip(string.whitespace + string.punctuation) for name in names]
     def postprocess_entity_description(descriptions, **kwargs):
@@ -31,8 +73,11 @@ def generate_entities(plan, llm_client, entity_prompt, entity_config):
         return responses
     name_config, description_config = entity_config['name'], entity_config['description']
     name_prompt, description_prompt = entity_prompt['name'], entity_prompt['description']
-    plan.entity_list = EntityList()
-    has_next = True
+    if journal is not None:
+        has_next = journal.restore_entities(plan)
+    else:
+        plan.entity_list = EntityList()
+        has_next = True
     while has_next:
         entity_name = llm_client.call_with_retry(
             name_prompt.format(
@@ -67,22 +112,74 @@ def generate_entities(plan, llm_client, entity_prompt, entity_config):
             has_next = True
         elif len(plan.entity_list) >= entity_config['max_entities']:
             has_next = False
+        if journal is not None:
+            journal.log('entity', name=entity_name, description=entity_description, has_next=has_next)
     return plan
 
 
-def generate_outline(plan, llm_client, outline_prompt, outline_config):
-    plan.outline = OutlineNode('', None)
+@traced()
+def generate_outline(plan, llm_client, outline_prompt, outline_config, journal=None, start_usage=None):
+    recovery_counts = {'child': 0, 'node': 0, 'ancestor': 0}
+    if journal is not None and journal.restore_outline(plan):
+        # finish any expansion that was interrupted partway through before selecting new nodes
+        for node in list(plan.outline.breadth_first_traverse()):
+            if len(node.children) > 0 and not journal.is_expanded(node):
+                expand_node_with_recovery(node, llm_client, outline_prompt, outline_config, plan, journal=journal, recovery_counts=recovery_counts)
+    else:
+        plan.outline = OutlineNode('', None)
+        if journal is not None:
+            journal.log('outline', id=plan.outline.id)
+    scheduler = ExpansionScheduler(plan.outline, outline_config, llm_client, start_usage=start_usage)
     while True:
         try:
-            node_to_expand = select_node_to_expand(plan.outline, outline_config)
+            node_to_expand = scheduler.pop()
         except StopIteration:
             break
-        generate_node_subevents(node_to_expand, llm_client, outline_prompt, outline_config, plan)
+        with span('expand_node', node='.'.join([str(i + 1) for i in node_path(node_to_expand)]), depth=node_to_expand.depth()):
+            expanded_node = expand_node_with_recovery(node_to_expand, llm_client, outline_prompt, outline_config, plan, journal=journal, recovery_counts=recovery_counts)
+        scheduler.expanded(expanded_node)
         logging.debug(plan.outline)
+    logging.info(f"Outline recoveries: {recovery_counts['child']} child retries, {recovery_counts['node']} node re-expansions, {recovery_counts['ancestor']} ancestor re-expansions")
     return plan
 
 
-def generate_node_subevents(node, llm_client, outline_prompt, outline_config, plan):
+def expand_node_with_recovery(node, llm_client, outline_prompt, outline_config, plan, journal=None, recovery_counts=None):
+    # handle failures at the smallest scope that fixes them: the failing child is retried inside generate_node_subevents,
+    # then the node's whole expansion is redone with perturbed sampling, then each ancestor's in turn.
+    # if even the root can't be re-expanded, the error propagates and the caller can restart the outline.
+    # returns the node whose expansion finally succeeded.
+    try:
+        generate_node_subevents(node, llm_client, outline_prompt, outline_config, plan, journal=journal, recovery_counts=recovery_counts)
+        return node
+    except Exception as e:
+        logging.warning(f"Failed to expand node {node.number().strip() or '(root)'}: {e}")
+    scope = node
+    while scope is not None:
+        for attempt in range(outline_config.get('subtree_max_attempts', 2)):
+            for child in list(scope.children):
+                remove_outline_node(child, journal=journal)
+            if recovery_counts is not None:
+                recovery_counts['node' if scope is node else 'ancestor'] += 1
+            logging.warning(f"Re-expanding node {scope.number().strip() or '(root)'} with perturbed sampling (attempt {attempt+1})")
+            try:
+                generate_node_subevents(
+                    scope, 
+                    llm_client, 
+                    outline_prompt, 
+                    outline_config, 
+                    plan, 
+                    journal=journal, 
+                    temperature_shift=(attempt+1) * outline_config.get('retry_temperature_increment', 0.1), 
+                    recovery_counts=recovery_counts
+                )
+                return scope
+            except Exception as e:
+                logging.warning(f"Failed to re-expand node {scope.number().strip() or '(root)'}: {e}")
+        scope = scope.parent
+    raise RuntimeError(f"Failed to expand node {node.number().strip() or '(root)'} even after re-expanding its ancestors")
+
+
+def generate_node_subevents(node, llm_client, outline_prompt, outline_config, plan, journal=None, temperature_shift=0, recovery_counts=None):
     def event_postprocessor(events, has_next_indicator, current_number, **kwargs):
         responses = []
         for event in events:
@@ -118,8 +215,15 @@ def generate_node_subevents(node, llm_client, outline_prompt, outline_config, pl
     else:
         event_config = outline_config['event']
         event_prompt = outline_prompt['event']
-    has_next = True
-    while has_next:
+    def continue_expansion(has_next):
+        if len(node.children) < outline_config['min_children']:
+            return True
+        elif len(node.children) >= outline_config['max_children']:
+            if has_next:
+                logging.warning(f"Max children reached but model not done generating for this expansion")
+            assert not has_next
+        return has_next
+    def generate_child():
         new_child = OutlineNode('', node)
         node.children.append(new_child)
         context_prefix, context_suffix = new_child.context(outline_config['context'])
@@ -141,34 +245,87 @@ def generate_node_subevents(node, llm_client, outline_prompt, outline_config, pl
                 successor_info=f'but before "{new_child.successor().text}"' if new_child.successor() is not None else 'The upcoming event(s) are the conclusion of the whole story, so make sure to wrap things up nicely.',
                 preferred_max_children=outline_config['preferred_max_children'],
             ),
-            SamplingConfig.from_config(event_config),
+            SamplingConfig.from_config(perturb_sampling(event_config, temperature_shift)),
             postprocessor=partial(event_postprocessor, has_next_indicator='\n' + new_child.number(lookforward=1).strip(), current_number=new_child.number(lookforward=0).strip()),
             filter=filter,
         )[0]
         new_child.text = event
+        if journal is not None:
+            journal.log('event', id=new_child.id, parent=node.id, text=event, has_next=has_next)
+        try:
+            generate_node_details(new_child, llm_client, outline_prompt, outline_config, plan, journal=journal, temperature_shift=temperature_shift)
+        except Exception:
+            remove_outline_node(new_child, journal=journal)
+            raise
+        logging.info(f"Newly generated node: {new_child}")
+        return has_next
+    has_next = True
+    if journal is not None and len(node.children) > 0:
+        # resuming an expansion from the journal; complete the last child if needed, then continue after it
+        for child in node.children:
+            generate_node_details(child, llm_client, outline_prompt, outline_config, plan, journal=journal, temperature_shift=temperature_shift)
+        has_next = continue_expansion(journal.event_has_next[node.children[-1].id])
+    while has_next:
+        # retry just the failing child before giving up on this expansion
+        child_max_attempts = outline_config.get('child_max_attempts', 1)
+        for attempt in range(child_max_attempts):
+            num_children = len(node.children)
+            try:
+                has_next = generate_child()
+                break
+            except Exception:
+                if len(node.children) > num_children:
+                    node.children = node.children[:num_children] # child whose event generation failed was never logged
+                if attempt == child_max_attempts - 1:
+                    raise
+                logging.warning(f"Failed to generate child {num_children + 1} of node {node.number().strip() or '(root)'}, retrying ({attempt+1}/{child_max_attempts})")
+                if recovery_counts is not None:
+                    recovery_counts['child'] += 1
+        has_next = continue_expansion(has_next)
+    if journal is not None:
+        journal.log('expanded', id=node.id)
+
+
+def perturb_sampling(config, temperature_shift):
+    if temperature_shift == 0:
+        return config
+    temperature = config.get('temperature', None)
+    temperature = 1 if temperature is None else temperature # an explicit 0 (greedy) is the base the shift is added to, not replaced by the default of 1
+    return config.override(temperature=temperature + temperature_shift)
+
+
+def remove_outline_node(node, journal=None):
+    node.parent.children.remove(node)
+    if journal is not None:
+        journal.log('remove', id=node.id)
+
+
+@traced()
+def generate_node_details(node, llm_client, outline_prompt, outline_config, plan, journal=None, temperature_shift=0):
+    # scene and entities for a node whose event text is already generated, skipping parts already in the journal
+    if journal is None or not journal.has_scene(node):
         generate_node_scene(
-            new_child, 
+            node, 
             llm_client, 
             outline_prompt['scene'], 
-            outline_config['scene'], 
+            perturb_sampling(outline_config['scene'], temperature_shift), 
             plan
         )
+        if journal is not None:
+            journal.log('scene', id=node.id, scene=node.scene)
+    if journal is None or not journal.has_entities(node):
         generate_node_entities(
-            new_child, 
+            node, 
             llm_client, 
-            outline_prompt['entity_depth_0'] if node.depth() == 0 else outline_prompt['entity'],
-            outline_config['entity_depth_0'] if node.depth() == 0 else outline_config['entity'],
+            outline_prompt['entity_depth_0'] if node.depth() == 1 else outline_prompt['entity'],
+            perturb_sampling(outline_config['entity_depth_0'] if node.depth() == 1 else outline_config['entity'], temperature_shift),
             plan
         )
-        logging.info(f"Newly generated node: {new_child}")
-        if len(node.children) < outline_config['min_children']:
-            has_next = True
-        elif len(node.children) >= outline_config['max_children']:
-            if has_next:
-                logging.warning(f"Max children reached but model not done generating for this expansion")
-            assert not has_next
+        if journal is not None:
+            journal.log('node_entities', id=node.id, entities=node.entities)
 
 
+@traced()
 def generate_node_scene(node, llm_client, scene_prompt, scene_config, plan):
     def scene_postprocessor(scenes, **kwargs):
         responses = []
@@ -200,6 +357,7 @@ def generate_node_scene(node, llm_client, scene_prompt, scene_config, plan):
     )[0]
 
 
+@traced()
 def generate_node_entities(node, llm_client, entity_prompt, entity_config, plan):
     def entity_postprocessor(predicted_entities_lists, entity_list, already_detected_entities, **kwargs):
         responses = []
@@ -248,13 +406,3 @@ def generate_node_entities(node, llm_client, entity_prompt, entity_config, plan)
         logging.warning(f"Failed to generate entities for node {node.number()} with text: {node.text}; using predecessor's entities instead")
         node.entities = [e for e in node.predecessor().entities]
     logging.debug(f"Generated entities: {node.entities}")
-
-
-def select_node_to_expand(outline, outline_config):
-    if outline_config['expansion_policy'] == 'breadth-first':
-        for node in outline.breadth_first_traverse(max_depth=outline_config['max_depth']-1):
-            if len(node.children) == 0:
-                return node
-        raise StopIteration
-    else:
-        raise NotImplementedError
\ No newline at end of file
@@ -1,9 +1,15 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+
 from storygen.common.llm.llm import SamplingConfig
-from storygen.common.util import min_max_tokens_filter
+from storygen.common.trace import traced
+from storygen.common.util import NearDuplicateIndex, append_jsonl, min_max_tokens_filter, read_jsonl
+from storygen.premise.premise import Premise
 
 
+@traced()
 def generate_title(premise_object, title_prompts, title_config, llm_client):
     title = llm_client.call_with_retry(
         title_prompts.format(), 
@@ -14,6 +20,7 @@ def generate_title(premise_object, title_prompts, title_config, llm_client):
     return premise_object
 
 
+@traced()
 def generate_premise(premise_object, premise_prompts, premise_config, llm_client):
     premise = llm_client.call_with_retry(
         premise_prompts.format(title=premise_object.title), 
@@ -21,4 +28,70 @@ def generate_premise(premise_object, premise_prompts, premise_config, llm_client
         filter=min_max_tokens_filter(0, premise_config['max_tokens'])
     )[0]
     premise_object.premise = premise
-    return premise_object
\ No newline at end of file
+    return premise_object
+
+@traced()
+def generate_titles(title_prompts, title_config, llm_client, n):
+    # n titles sampled from a single request
+    return llm_client.call_with_retry(
+        title_prompts.format(), 
+        SamplingConfig.from_config(title_config.override(n=n)),
+        filter=min_max_tokens_filter(0, title_config['max_tokens'])
+    )
+
+
+@traced()
+def generate_premises_bulk(title_prompts, title_config, premise_prompts, premise_config, llm_client, bulk_config):
+    # generate titles n at a time and premises for them concurrently, dropping near-duplicate titles and premises.
+    # results are appended to a jsonl file as they complete; rerunning resumes from whatever is already there.
+    output_path = bulk_config['output_path']
+    title_index = NearDuplicateIndex(threshold=bulk_config['title_dedup_threshold'])
+    premise_index = NearDuplicateIndex(threshold=bulk_config['premise_dedup_threshold'])
+    num_done = 0
+    for record in read_jsonl(output_path):
+        title_index.add(record['title'])
+        premise_index.add(record['premise'])
+        num_done += 1
+    if num_done > 0:
+        logging.info(f"Resuming bulk premise generation with {num_done} premises already in {output_path}")
+
+    def make_premise(title):
+        return generate_premise(Premise(title=title), premise_prompts, premise_config, llm_client)
+
+    pending = set()
+    stale_title_batches = 0
+    with ThreadPoolExecutor(max_workers=bulk_config['max_concurrency']) as executor:
+        while num_done < bulk_config['num_premises']:
+            # keep enough premise requests in flight to reach the target, but no more than max_concurrency
+            while len(pending) < bulk_config['max_concurrency'] and num_done + len(pending) < bulk_config['num_premises']:
+                try:
+                    titles = generate_titles(title_prompts, title_config, llm_client, bulk_config['titles_per_request'])
+                except RuntimeError:
+                    titles = []
+                new_titles = [title for title in titles if title_index.add(title)]
+                if len(new_titles) == 0:
+                    stale_title_batches += 1
+                    if stale_title_batches >= bulk_config['max_stale_title_batches']:
+                        break
+                    continue
+                stale_title_batches = 0
+                for title in new_titles[:bulk_config['num_premises'] - num_done - len(pending)]:
+                    pending.add(executor.submit(make_premise, title))
+            if len(pending) == 0:
+                logging.warning(f"No new titles after {stale_title_batches} consecutive requests; stopping with {num_done} premises")
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    premise = future.result()
+                except RuntimeError:
+                    logging.warning(f"Failed to generate a premise; skipping")
+                    continue
+                if not premise_index.add(premise.premise):
+                    logging.debug(f"Dropping near-duplicate premise: {premise.premise}")
+                    continue
+                append_jsonl(output_path, {'title': premise.title, 'premise': premise.premise})
+                num_done += 1
+                if num_done % 100 == 0:
+                    logging.info(f"Generated {num_done}/{bulk_config['num_premises']} premises")
+    return num_done
@@ -0,0 +1,43 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import math
+import threading
+
+
+class AdaptiveCandidateCount:
+    # chooses the number of passage candidates (PASSAGE.n) for each request in one story. it tracks how many wanted
+    # candidates to end up with after filtering, shrinking that when the best candidate wins by a clear margin and
+    # growing it when the top candidates are close, and requests that many divided by the recent acceptance rate.
+    # the bounds are read from the passage config at each request, so budget degradation still caps them.
+    # shared by all beam members of the story
+    def __init__(self, passage_config, decay=0.7, shrink=0.8, grow=1.25):
+        self.lock = threading.Lock()
+        self.decay = decay
+        self.shrink = shrink
+        self.grow = grow
+        self.acceptance = 1.0 # moving average of the fraction of candidates passing the filter with a viable score
+        self.wanted = float(passage_config['n']) # accepted candidates wanted per request
+
+    def next_n(self, passage_config):
+        min_n, max_n = passage_config.get('min_n', 1), passage_config.get('max_n', passage_config['n'])
+        with self.lock:
+            n = math.ceil(self.wanted / max(self.acceptance, 0.1))
+        return max(min_n, min(max_n, n))
+
+    def record(self, num_requested, scores, multiplicities, passage_config):
+        # scores of the distinct candidates that passed the filter, and how many of the requested candidates each stands for
+        if num_requested == 0:
+            return
+        viable = sorted([(score, multiplicity) for score, multiplicity in zip(scores, multiplicities) if score > passage_config.get('min_viable_score', -50)], reverse=True)
+        with self.lock:
+            # duplicates passed the filter too, so they count as accepted
+            self.acceptance = self.decay * self.acceptance + (1 - self.decay) * sum([multiplicity for _, multiplicity in viable]) / num_requested
+            if len(viable) >= 2 and viable[0][0] - viable[1][0] >= passage_config.get('margin_threshold', 1.0):
+                self.wanted *= self.shrink
+            elif len(viable) == 1 and viable[0][1] >= 2:
+                # the model keeps sampling the same passage and nothing else is viable: as clear a win as it gets
+                self.wanted *= self.shrink
+            else:
+                # a close call, or too few viable candidates to compare
+                self.wanted *= self.grow
+            self.wanted = max(1.0, min(float(passage_config.get('max_n', passage_config['n'])), self.wanted))
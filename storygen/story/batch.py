@@ -0,0 +1,91 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import json
+import logging
+import os
+from pathlib import Path
+import time
+import traceback
+
+from storygen.common.util import *
+from storygen.plan.plan import Plan
+from storygen.story.export import *
+from storygen.story.story_writer import *
+
+
+def load_story_manifest(manifest_path, output_dir):
+    # one json object per line with a plan_path, and optionally an id (default: the plan file's name) and output_path
+    entries = []
+    with open(manifest_path, 'r') as f:
+        records = [json.loads(line) for line in f if line.strip() != '']
+    for record in records:
+        story_id = record.get('id', Path(record['plan_path']).stem)
+        entries.append({
+            'id': story_id,
+            'plan_path': record['plan_path'],
+            'output_path': record.get('output_path', os.path.join(output_dir, f'{story_id}.txt')),
+        })
+    if len(set([entry['id'] for entry in entries])) < len(entries):
+        raise ValueError(f"Story ids in {manifest_path} must be unique")
+    return entries
+
+
+def generate_stories_batch(entries, story_config, story_prompts, llm_client, batch_config):
+    # render many plans concurrently in one process, sharing one LLMClient (and so its cap on requests in flight).
+    # a failing story is logged and recorded without affecting the others. a results record is appended to
+    # results_path as each story finishes; rerunning skips stories that already succeeded and retries failed ones
+    results_path = batch_config['results_path']
+    done_ids = set([record['id'] for record in read_jsonl(results_path) if record['status'] == 'ok'])
+    entries = [entry for entry in entries if entry['id'] not in done_ids]
+    if len(done_ids) > 0:
+        logging.info(f"Resuming batch with {len(done_ids)} stories already done in {results_path}; {len(entries)} to go")
+    export_dataset_path = batch_config.get('export_dataset_path', None)
+    run_id = new_run_id()
+
+    def run(entry):
+        start_time = time.time()
+        usage = Usage()
+        result = {'id': entry['id'], 'plan_path': entry['plan_path'], 'output_path': entry['output_path']}
+        try:
+            plan = Plan.load(entry['plan_path'])
+            checkpoint_path = os.path.join(batch_config['checkpoint_dir'], f"{entry['id']}.jsonl") if batch_config.get('checkpoint_dir', None) is not None else None
+            candidates = CandidateCollector() if export_dataset_path is not None and batch_config.get('export_candidates', True) else None
+            story = generate_story(plan, story_config, story_prompts, llm_client, checkpoint_path=checkpoint_path, usage=usage, event_callback=candidates.on_event if candidates is not None else None)[0]
+            os.makedirs(os.path.dirname(entry['output_path']) or '.', exist_ok=True)
+            story.save(entry['output_path'] + '.tmp')
+            os.replace(entry['output_path'] + '.tmp', entry['output_path'])
+            if export_dataset_path is not None:
+                export_story(export_dataset_path, story, entry['id'], run_id, candidates=candidates.candidates if candidates is not None else ())
+            result['status'] = 'ok'
+        except Exception as e:
+            logging.warning(f"Failed to generate story {entry['id']}: {traceback.format_exc()}")
+            result['status'] = 'failed'
+            result['error'] = repr(e)
+        result['seconds'] = time.time() - start_time
+        result['usage'] = {'calls': usage.calls, 'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens}
+        return result
+
+    num_ok, num_failed = 0, 0
+    pending = set()
+    entries = iter(entries)
+    with ThreadPoolExecutor(max_workers=batch_config['max_concurrent_stories']) as executor:
+        while True:
+            # admit new stories as others finish, so at most max_concurrent_stories are in progress
+            for entry in entries:
+                pending.add(executor.submit(run, entry))
+                if len(pending) >= batch_config['max_concurrent_stories']:
+                    break
+            if len(pending) == 0:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                append_jsonl(results_path, result)
+                if result['status'] == 'ok':
+                    num_ok += 1
+                else:
+                    num_failed += 1
+                logging.info(f"Finished story {result['id']} ({result['status']}, {result['seconds']:.0f}s); {num_ok} ok, {num_failed} failed so far")
+    logging.info(f"Batch done: {num_ok} ok, {num_failed} failed; total usage {llm_client.usage}")
+    return num_ok, num_failed
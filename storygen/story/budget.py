@@ -0,0 +1,75 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import logging
+import time
+
+
+# LLM scorers in the order they're dropped, most expensive prompt first
+EXPENSIVE_SCORERS = ['coherence', 'relevance', 'commentary']
+
+
+def degrade_story_config(story_config, step):
+    if step == 'candidates':
+        # half as many passage candidates per request, including the bounds for adaptive n
+        passage_config = story_config['passage']
+        overrides = {key: max(1, passage_config[key] // 2) for key in ['n', 'min_n', 'max_n'] if passage_config.get(key, None) is not None}
+        return story_config.override(passage=passage_config.override(**overrides))
+    elif step == 'beam':
+        # half as wide passage and outline node beams
+        return story_config.override(
+            passage_beam_width=max(1, story_config['passage_beam_width'] // 2), 
+            outline_node_beam_width=max(1, story_config['outline_node_beam_width'] // 2)
+        )
+    elif step == 'scorers':
+        # drop the most expensive remaining LLM scorer
+        scorers = list(story_config['score']['scorers'])
+        for scorer in EXPENSIVE_SCORERS:
+            if scorer in scorers:
+                scorers.remove(scorer)
+                break
+        return story_config.override(score=story_config['score'].override(scorers=scorers))
+    else:
+        raise NotImplementedError(f"Budget degradation step {step} not implemented.")
+
+
+class StoryBudget:
+    # caps one story's LLM calls, tokens and wall-clock time. before each outline node, the spend so far is
+    # extrapolated over the rest of the story; if that overruns the budget, the story config is degraded one more
+    # step in the configured order. degradation is never undone, so cost only moves toward the envelope. once any
+    # budget is used up, every step is applied and each node stops at min_passages_per_node
+    def __init__(self, budget_config, usage):
+        budget_config = budget_config if budget_config is not None else {}
+        self.max_calls = budget_config.get('max_calls', None)
+        self.max_tokens = budget_config.get('max_tokens', None)
+        self.max_seconds = budget_config.get('max_seconds', None)
+        self.degradation = list(budget_config.get('degradation', None) or [])
+        self.usage = usage
+        self.level = 0
+        self.start_time = time.time()
+
+    def fraction_spent(self):
+        fractions = [0]
+        for budget, spent in [(self.max_calls, self.usage.calls), (self.max_tokens, self.usage.total_tokens()), (self.max_seconds, time.time() - self.start_time)]:
+            if budget is not None:
+                fractions.append(spent / budget)
+        return max(fractions)
+
+    def exhausted(self):
+        return self.fraction_spent() >= 1
+
+    def update(self, progress):
+        # progress is the fraction of the story's outline nodes rendered so far
+        if self.exhausted():
+            if self.level <= len(self.degradation):
+                logging.warning(f"Story budget used up ({self.usage}, {time.time() - self.start_time:.0f}s); rendering the rest at minimum cost")
+            self.level = len(self.degradation) + 1
+        elif progress > 0 and self.fraction_spent() / progress > 1 and self.level < len(self.degradation):
+            logging.info(f"Story on track to use {100 * self.fraction_spent() / progress:.0f}% of its budget after {100 * progress:.0f}% of the outline; degrading {self.degradation[self.level]}")
+            self.level += 1
+
+    def apply(self, story_config):
+        for step in self.degradation[:self.level]:
+            story_config = degrade_story_config(story_config, step)
+        if self.level > len(self.degradation):
+            story_config = story_config.override(max_passages_per_node=story_config['min_passages_per_node'])
+        return story_config
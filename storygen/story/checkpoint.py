@@ -0,0 +1,205 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import json
+import logging
+import os
+import threading
+import uuid
+
+from storygen.common.util import *
+from storygen.story.story import *
+
+
+class FileCheckpointStore:
+    # where checkpoint logs are read and written. the distributed mode wraps one in an actor, so story tasks on any
+    # host keep their checkpoints on the node running the actor
+    def read(self, path):
+        return read_jsonl(path)
+
+    def append(self, path, record):
+        append_jsonl(path, record)
+
+    def replace(self, path, records):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def delete(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class StoryCheckpointLog:
+    # append-only log of story generation progress. each record only holds what changed since the last one: passages
+    # and story cells (one outline node's passage list, pointing to the previous cell) not yet in the log, then the
+    # beam as a list of cell ids. beams are recorded after every outline node, and optionally after every passage
+    # step inside render_node. records are fsynced as they're written, and the log is periodically compacted down
+    # to what the latest beams can reach by atomically replacing the file.
+    def __init__(self, path, plan, compact_factor=2, store=None):
+        self.path = path
+        self.plan = plan
+        self.store = store if store is not None else FileCheckpointStore()
+        self.compact_factor = compact_factor
+        self.lock = threading.Lock()
+        self.logged_ids = set()
+        self.latest_beam = None # latest node-level beam record
+        self.node_progress = {} # (node id, source cell id) -> latest passage-level record for that render_node call
+        self.num_records = 0
+        self.compacted_size = 1
+        self.passages = {}
+        self.cells = {}
+        records = self.store.read(path)
+        if len(records) == 0:
+            self._append({'type': 'header', 'outline': plan.outline.id})
+        elif records[0]['outline'] != plan.outline.id:
+            raise ValueError(f"Story checkpoint {path} was written for a different plan; delete it to start over.")
+        else:
+            self._replay(records)
+
+    def _append(self, record):
+        self.store.append(self.path, record)
+        self.num_records += 1
+
+    def _replay(self, records):
+        passage_records, cell_records = {}, {}
+        for record in records:
+            if record['type'] == 'passage':
+                passage_records[record['id']] = record
+            elif record['type'] == 'cell':
+                cell_records[record['id']] = record
+            elif record['type'] == 'beam':
+                self.latest_beam = record
+                self.node_progress = {} # progress within earlier nodes is no longer needed
+            elif record['type'] == 'node_progress':
+                self.node_progress[(record['node'], record['source'])] = record
+        nodes = {node.id: node for node in self.plan.outline.depth_first_traverse()}
+        for passage_id, record in passage_records.items():
+            self.passages[passage_id] = Passage(record['text'], record['aux_info'], id=passage_id, finish_reason=record.get('finish_reason', None), num_tokens=record.get('num_tokens', None))
+        for cell_id in cell_records:
+            # build cells iteratively from the oldest unbuilt ancestor, since chains can be long
+            chain = []
+            while cell_id is not None and cell_id not in self.cells:
+                chain.append(cell_records[cell_id])
+                cell_id = cell_records[cell_id]['prev']
+            for record in reversed(chain):
+                passage_list = OutlineNodePassageList(nodes[record['node']], [self.passages[passage_id] for passage_id in record['passages']])
+                prev = self.cells[record['prev']] if record['prev'] is not None else None
+                self.cells[record['id']] = StoryCell(passage_list, prev, id=record['id'])
+        self.logged_ids = set(passage_records) | set(cell_records)
+        self.num_records = len(records)
+        self.compacted_size = len(records)
+        logging.info(f"Loaded story checkpoint {self.path} ({len(records)} records)")
+
+    def _stories(self, cell_ids):
+        return [Story.from_tail(self.plan, self.cells[cell_id] if cell_id is not None else None) for cell_id in cell_ids]
+
+    def load_beam(self):
+        # latest node-level beam, or None if there isn't one yet
+        if self.latest_beam is None:
+            return None
+        return StoryBeam(self._stories(self.latest_beam['stories']))
+
+    def load_node_progress(self, node, source_story):
+        # latest passage-level (passage step, beam, best stories) for rendering node from source_story, if any
+        source_id = source_story.tail.id if source_story.tail is not None else None
+        record = self.node_progress.get((node.id, source_id), None)
+        if record is None:
+            return None
+        return record['passage_step'], StoryBeam(self._stories(record['beam'])), StoryBeam(self._stories(record['best']))
+
+    def _log_story(self, story):
+        # write any of the story's passages and cells that aren't in the log yet, walking back only as far as needed
+        cells = []
+        cell = story.tail
+        while cell is not None and (cell.id is None or cell.id not in self.logged_ids):
+            cells.append(cell)
+            cell = cell.prev
+        for cell in reversed(cells):
+            for passage in cell.passage_list.passages:
+                if passage.id is None:
+                    passage.id = uuid.uuid4().hex
+                if passage.id not in self.logged_ids:
+                    self._append({'type': 'passage', 'id': passage.id, 'text': passage.text, 'aux_info': passage.aux_info, 'finish_reason': passage.finish_reason, 'num_tokens': passage.num_tokens})
+                    self.logged_ids.add(passage.id)
+                    self.passages[passage.id] = passage
+            if cell.id is None:
+                cell.id = uuid.uuid4().hex
+            self._append({
+                'type': 'cell', 
+                'id': cell.id, 
+                'prev': cell.prev.id if cell.prev is not None else None, 
+                'node': cell.passage_list.outline_node.id, 
+                'passages': [passage.id for passage in cell.passage_list.passages]
+            })
+            self.logged_ids.add(cell.id)
+            self.cells[cell.id] = cell
+        return story.tail.id if story.tail is not None else None
+
+    def log_beam(self, beam, step):
+        with self.lock:
+            record = {'type': 'beam', 'step': step, 'stories': [self._log_story(story) for story in beam]}
+            self._append(record)
+            self.latest_beam = record
+            self.node_progress = {}
+            if self.num_records > self.compact_factor * self.compacted_size:
+                self._compact()
+
+    def log_node_progress(self, node, source_story, passage_step, beam, best_stories):
+        with self.lock:
+            source_id = self._log_story(source_story)
+            record = {
+                'type': 'node_progress', 
+                'node': node.id, 
+                'source': source_id, 
+                'passage_step': passage_step, 
+                'beam': [self._log_story(story) for story in beam], 
+                'best': [self._log_story(story) for story in best_stories]
+            }
+            self._append(record)
+            self.node_progress[(node.id, source_id)] = record
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        # rewrite the log with only what the latest beam and in-progress nodes can reach, then atomically swap it in
+        live_records = ([self.latest_beam] if self.latest_beam is not None else []) + list(self.node_progress.values())
+        live_cell_ids = set()
+        for record in live_records:
+            for cell_id in record.get('stories', []) + record.get('beam', []) + record.get('best', []) + [record.get('source', None)]:
+                while cell_id is not None and cell_id not in live_cell_ids:
+                    live_cell_ids.add(cell_id)
+                    cell_id = self.cells[cell_id].prev.id if self.cells[cell_id].prev is not None else None
+        records = [{'type': 'header', 'outline': self.plan.outline.id}]
+        written_passage_ids = set()
+        # write earlier cells first, so each cell's prev precedes it as in the original log
+        for cell_id in sorted(live_cell_ids, key=lambda cell_id: self.cells[cell_id].num_lists):
+            cell = self.cells[cell_id]
+            for passage in cell.passage_list.passages:
+                if passage.id not in written_passage_ids:
+                    records.append({'type': 'passage', 'id': passage.id, 'text': passage.text, 'aux_info': passage.aux_info, 'finish_reason': passage.finish_reason, 'num_tokens': passage.num_tokens})
+                    written_passage_ids.add(passage.id)
+            records.append({
+                'type': 'cell', 
+                'id': cell.id, 
+                'prev': cell.prev.id if cell.prev is not None else None, 
+                'node': cell.passage_list.outline_node.id, 
+                'passages': [passage.id for passage in cell.passage_list.passages]
+            })
+        records += live_records
+        self.store.replace(self.path, records)
+        self.logged_ids = written_passage_ids | live_cell_ids
+        self.passages = {passage_id: self.passages[passage_id] for passage_id in written_passage_ids}
+        self.cells = {cell_id: self.cells[cell_id] for cell_id in live_cell_ids}
+        logging.debug(f"Compacted story checkpoint from {self.num_records} to {len(records)} records")
+        self.num_records = len(records)
+        self.compacted_size = len(records)
+
+    def delete(self):
+        with self.lock:
+            self.store.delete(self.path)
@@ -0,0 +1,339 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+import traceback
+
+import ray
+
+from storygen.common.llm.llm import *
+from storygen.common.util import *
+from storygen.plan.plan import Plan
+from storygen.plan.plan_writer import generate_plan
+from storygen.premise.premise import Premise
+from storygen.premise.premise_writer import generate_premise, generate_title
+from storygen.story.checkpoint import FileCheckpointStore
+from storygen.story.story_writer import *
+
+
+# distributed mode: premises, plans and stories are ray tasks, so one queue of jobs can be spread over a cluster.
+# the tasks share pools of LLM worker actors that particular stages (e.g. the scorers) are sent to, and actors holding
+# state that should outlive any one task attempt: a cache of responses, usage metrics, and checkpoint logs. a task
+# retried after its worker dies picks up the cached responses and resumes from its checkpoint.
+
+def init_ray(distributed_config):
+    if distributed_config.get('local_mode', False):
+        # everything in this process, for testing on a single cpu-only machine
+        ray.init(local_mode=True, num_cpus=distributed_config.get('num_cpus', None) or 1, ignore_reinit_error=True)
+    else:
+        ray.init(address=distributed_config.get('address', None), num_cpus=distributed_config.get('num_cpus', None), ignore_reinit_error=True)
+    logging.info(f"Ray resources: {ray.cluster_resources()}")
+
+
+@ray.remote
+class LLMWorker:
+    # an LLMClient in its own process, serving requests from many tasks at once (up to the actor's max_concurrency)
+    def __init__(self, client_kwargs):
+        self.client = LLMClient(**client_kwargs)
+
+    def call(self, prompt_builder, sampling_config, kwargs):
+        return self.client._scheduled_call(prompt_builder, sampling_config, **kwargs)
+
+    def usage(self):
+        return str(self.client.usage)
+
+
+class WorkerPool:
+    # handles to a set of LLMWorker actors; picklable, so tasks can be given the pool
+    def __init__(self, name, num_workers, client_kwargs):
+        self.name = name
+        max_concurrency = client_kwargs.get('max_in_flight', None) or 32
+        self.workers = [LLMWorker.options(max_concurrency=max_concurrency).remote(client_kwargs) for _ in range(num_workers)]
+
+    def call(self, prompt_builder, sampling_config, **kwargs):
+        return ray.get(random.choice(self.workers).call.remote(prompt_builder, sampling_config, kwargs))
+
+    def usage(self):
+        return ray.get([worker.usage.remote() for worker in self.workers])
+
+
+@ray.remote
+class ResponseCache:
+    # LLM responses by request, for stages whose responses can be reused (e.g. scorer logprobs); lru eviction
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        if self.max_size is not None and len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return f'{len(self.entries)} entries, {self.hits} hits, {self.misses} misses ({100 * self.hits / max(self.hits + self.misses, 1):.1f}% hit rate)'
+
+
+@ray.remote
+class Metrics:
+    # LLM usage and latency per stage, and job outcomes, across all tasks
+    def __init__(self):
+        self.stages = {}
+        self.jobs = {}
+
+    def record_request(self, stage, prompt_tokens, completion_tokens, seconds, cached=False):
+        stage_metrics = self.stages.setdefault(stage, {'calls': 0, 'cached': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'seconds': 0.0})
+        stage_metrics['calls'] += 1
+        stage_metrics['cached'] += int(cached)
+        stage_metrics['prompt_tokens'] += prompt_tokens
+        stage_metrics['completion_tokens'] += completion_tokens
+        stage_metrics['seconds'] += seconds
+
+    def record_job(self, step, status):
+        self.jobs.setdefault(step, {}).setdefault(status, 0)
+        self.jobs[step][status] += 1
+
+    def summary(self):
+        return {'stages': self.stages, 'jobs': self.jobs}
+
+
+CheckpointStoreActor = ray.remote(FileCheckpointStore)
+
+
+class RemoteCheckpointStore:
+    # the FileCheckpointStore interface, forwarded to a CheckpointStoreActor
+    def __init__(self, actor):
+        self.actor = actor
+
+    def read(self, path):
+        return ray.get(self.actor.read.remote(path))
+
+    def append(self, path, record):
+        ray.get(self.actor.append.remote(path, record))
+
+    def replace(self, path, records):
+        ray.get(self.actor.replace.remote(path, records))
+
+    def delete(self, path):
+        ray.get(self.actor.delete.remote(path))
+
+
+class RayServices:
+    # everything a task needs to reach the shared actors; picklable, so it's passed to each task
+    def __init__(self, distributed_config, client_kwargs):
+        self.client_kwargs = client_kwargs
+        self.pools = {}
+        for name, pool_config in (distributed_config.get('pools', None) or {}).items():
+            pool = WorkerPool(name, pool_config['num_workers'], {**client_kwargs, 'max_in_flight': pool_config.get('max_in_flight', None)})
+            for stage in pool_config['stages']:
+                self.pools[stage] = pool
+        self.cache_stages = list(distributed_config.get('cache_stages', None) or [])
+        self.cache = ResponseCache.remote(distributed_config.get('cache_size', None)) if len(self.cache_stages) > 0 else None
+        self.metrics = Metrics.remote()
+        self.checkpoint_store_actor = CheckpointStoreActor.remote()
+
+    def client(self):
+        return RayLLMClient(self, **self.client_kwargs)
+
+    def checkpoint_store(self):
+        return RemoteCheckpointStore(self.checkpoint_store_actor)
+
+
+class RayLLMClient(LLMClient):
+    # an LLMClient whose requests for some stages go to worker pools, with accepted responses for cache_stages shared
+    # through the ResponseCache. usage is still recorded here (and to any per-story trackers), as for local requests
+    def __init__(self, services, **kwargs):
+        super().__init__(**kwargs)
+        self.services = services
+
+    def call_with_retry(self, prompt_builder, sampling_config, postprocessor=None, **kwargs):
+        # cached at this level rather than per request, so only responses that passed the filter are shared and a
+        # rejected response is resampled on retry. postprocessed results depend on the caller's state, so aren't cached
+        stage = kwargs.get('stage', 'other')
+        if self.services.cache is None or stage not in self.services.cache_stages or postprocessor is not None:
+            return super().call_with_retry(prompt_builder, sampling_config, postprocessor=postprocessor, **kwargs)
+        start_time = time.time()
+        prompt = prompt_builder.render_for_llm_format(sampling_config.prompt_format)
+        cache_key = hashlib.sha1(json.dumps([prompt, sampling_config.dict(), kwargs.get('return_full_completion', False)], sort_keys=True).encode('utf-8')).hexdigest()
+        cached = ray.get(self.services.cache.get.remote(cache_key))
+        if cached is not None:
+            self.services.metrics.record_request.remote(stage, 0, 0, time.time() - start_time, cached=True)
+            return cached
+        result = super().call_with_retry(prompt_builder, sampling_config, **kwargs)
+        self.services.cache.put.remote(cache_key, result)
+        return result
+
+    def _call(self, prompt_builder, sampling_config, **kwargs):
+        stage = kwargs.get('stage', 'other')
+        start_time = time.time()
+        if stage in self.services.pools:
+            remote_kwargs = {key: kwargs[key] for key in ['stage', 'time_limit'] if key in kwargs}
+            texts, completion = self.services.pools[stage].call(prompt_builder, sampling_config, **remote_kwargs)
+            self.record_usage(sampling_config, prompt_builder.render_for_llm_format(sampling_config.prompt_format), completion, stage=stage)
+        else:
+            texts, completion = super()._call(prompt_builder, sampling_config, **kwargs)
+        usage = completion.get('usage', None) or {}
+        # fire and forget; metrics don't need to be recorded before the story moves on
+        self.services.metrics.record_request.remote(stage, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0), time.time() - start_time)
+        return texts, completion
+
+
+@ray.remote(max_retries=2)
+def premise_task(job, premise_prompts, premise_config, services):
+    client = services.client()
+    premise = Premise()
+    generate_title(premise, premise_prompts['title'], premise_config['title'], client)
+    generate_premise(premise, premise_prompts['premise'], premise_config['premise'], client)
+    return premise
+
+
+@ray.remote(max_retries=2)
+def plan_task(job, premise, plan_prompts, plan_config, services):
+    return generate_plan(premise, plan_prompts, plan_config, services.client())
+
+
+@ray.remote(max_retries=2)
+def story_task(job, plan, story_prompts, story_config, services, checkpoint_dir=None):
+    # the checkpoint lives with the checkpoint store actor, so a retry of this task on another worker resumes from it
+    checkpoint_path = os.path.join(checkpoint_dir, f"{job['id']}.jsonl") if checkpoint_dir is not None else None
+    checkpoint_store = services.checkpoint_store()
+    if checkpoint_path is not None:
+        records = checkpoint_store.read(checkpoint_path)
+        if len(records) > 0 and records[0]['outline'] != plan.outline.id:
+            # e.g. left by an earlier run whose plan was never saved; it can't be resumed against this plan
+            logging.warning(f"Discarding story checkpoint {checkpoint_path}, which was written for a different plan")
+            checkpoint_store.delete(checkpoint_path)
+    story = generate_story(plan, story_config, story_prompts, services.client(), checkpoint_path=checkpoint_path, checkpoint_store=checkpoint_store)[0]
+    return str(story)
+
+
+def load_job_manifest(manifest_path):
+    # one json object per line with an id, and a plan_path (render just the story), a premise_path (plan and story),
+    # or neither (premise, plan and story)
+    with open(manifest_path, 'r') as f:
+        jobs = [json.loads(line) for line in f if line.strip() != '']
+    if len(set([job['id'] for job in jobs])) < len(jobs):
+        raise ValueError(f"Job ids in {manifest_path} must be unique")
+    return jobs
+
+
+def run_jobs(jobs, configs, prompts, distributed_config):
+    # configs and prompts hold each step's ('premise', 'plan' and 'story') config and prompts. each job's steps are chained
+    # task to task, so ray runs each step as soon as the previous one is done and a worker is free. each step's output
+    # is saved to output_dir/<job id>/ on this machine as it finishes, and one results record per job is appended to
+    # results_path. rerunning skips jobs that already succeeded, and resumes the rest from their saved steps
+    results_path = distributed_config['results_path']
+    done_ids = set([record['id'] for record in read_jsonl(results_path) if record['status'] == 'ok'])
+    jobs = [job for job in jobs if job['id'] not in done_ids]
+    if len(done_ids) > 0:
+        logging.info(f"Resuming with {len(done_ids)} jobs already done in {results_path}; {len(jobs)} to go")
+    client_kwargs = {
+        'max_in_flight': configs['story'].get('max_in_flight_requests', None),
+        'requests_per_minute': configs['story'].get('requests_per_minute', None),
+        'tokens_per_minute': configs['story'].get('tokens_per_minute', None),
+    }
+    services = RayServices(distributed_config, client_kwargs)
+    checkpoint_dir = distributed_config.get('checkpoint_dir', None)
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True) # on this machine, where the checkpoint store actor is started
+
+    def submit(job):
+        # returns the refs of the job's steps that need to run, in order. a premise or plan saved by an earlier run of
+        # this job is reused rather than regenerated, so the story resumes from its checkpoint against the same plan
+        job_output_dir = os.path.join(distributed_config['output_dir'], job['id'])
+        plan_path = job.get('plan_path', None)
+        if plan_path is None and os.path.exists(os.path.join(job_output_dir, 'plan.json')):
+            plan_path = os.path.join(job_output_dir, 'plan.json')
+        premise_path = job.get('premise_path', None)
+        if premise_path is None and os.path.exists(os.path.join(job_output_dir, 'premise.json')):
+            premise_path = os.path.join(job_output_dir, 'premise.json')
+        refs = {}
+        if plan_path is not None:
+            plan = Plan.load(plan_path)
+        else:
+            if premise_path is not None:
+                premise = Premise.load(premise_path)
+            else:
+                premise = refs['premise'] = premise_task.remote(job, prompts['premise'], configs['premise']['model'], services)
+            plan = refs['plan'] = plan_task.remote(job, premise, prompts['plan'], configs['plan']['model'], services)
+        refs['story'] = story_task.remote(job, plan, prompts['story']['story'], configs['story']['model']['story'], services, checkpoint_dir=checkpoint_dir)
+        return refs
+
+    def save_step(job, step, ref):
+        # premises and plans are saved as soon as they're done, so an interrupted job doesn't regenerate them
+        output_dir = os.path.join(distributed_config['output_dir'], job['id'])
+        os.makedirs(output_dir, exist_ok=True)
+        output = ray.get(ref)
+        if step == 'story':
+            with open(os.path.join(output_dir, 'story.txt'), 'w') as f:
+                f.write(output)
+        else:
+            output.save(os.path.join(output_dir, f'{step}.json'))
+        services.metrics.record_job.remote(step, 'ok')
+
+    job_refs = {} # job id -> refs of its steps not yet saved
+    pending = {} # step ref -> (job, step)
+    submit_times = {}
+    jobs = iter(jobs)
+    num_in_flight, num_ok, num_failed = 0, 0, 0
+    while True:
+        # keep at most max_concurrent_jobs jobs in flight, so a long queue doesn't hold every plan in the object store
+        while num_in_flight < distributed_config['max_concurrent_jobs']:
+            job = next(jobs, None)
+            if job is None:
+                break
+            job_refs[job['id']] = submit(job)
+            for step, ref in job_refs[job['id']].items():
+                pending[ref] = (job, step)
+            submit_times[job['id']] = time.time()
+            num_in_flight += 1
+        if len(pending) == 0:
+            break
+        done, _ = ray.wait(list(pending.keys()), num_returns=1)
+        job, step = pending.pop(done[0])
+        if step != 'story':
+            if step in job_refs.get(job['id'], {}):
+                try:
+                    save_step(job, step, job_refs[job['id']].pop(step))
+                except Exception:
+                    pass # the story step fails with the same error, and the job is recorded as failed then
+            continue
+        result = {'id': job['id'], 'seconds': time.time() - submit_times.pop(job['id'])}
+        try:
+            # any earlier steps not saved yet (finished in the same wait) go first, so a finished job has all its outputs
+            for step, ref in job_refs.pop(job['id']).items():
+                save_step(job, step, ref)
+            result['status'] = 'ok'
+        except Exception as e:
+            logging.warning(f"Job {job['id']} failed: {traceback.format_exc()}")
+            services.metrics.record_job.remote('job', 'failed')
+            result['status'] = 'failed'
+            result['error'] = repr(e)
+        num_in_flight -= 1
+        append_jsonl(results_path, result)
+        if result['status'] == 'ok':
+            num_ok += 1
+        else:
+            num_failed += 1
+        logging.info(f"Finished job {job['id']} ({result['status']}); {num_ok} ok, {num_failed} failed so far")
+
+    metrics = ray.get(services.metrics.summary.remote())
+    for stage, stage_metrics in sorted(metrics['stages'].items()):
+        logging.info(f"{stage}: {stage_metrics['calls']} calls ({stage_metrics['cached']} cached), {stage_metrics['prompt_tokens']} prompt tokens, {stage_metrics['completion_tokens']} completion tokens, {stage_metrics['seconds'] / max(stage_metrics['calls'], 1):.2f}s average")
+    if services.cache is not None:
+        logging.info(f"Response cache: {ray.get(services.cache.stats.remote())}")
+    return num_ok, num_failed
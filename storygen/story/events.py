@@ -0,0 +1,50 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import threading
+
+
+def emit_event(kwargs, event_type, **data):
+    # events are plain dicts with a 'type', passed to the event_callback threaded through the story writer's kwargs.
+    # callbacks may be called from worker threads
+    if kwargs.get('event_callback', None) is not None:
+        kwargs['event_callback']({'type': event_type, **data})
+
+
+class StoryCommitTracker:
+    # tracks the passages that every live story agrees on. any story the beam search can still return extends one
+    # of the live stories (the beam, or within render_node each source story's passage beam and best stories),
+    # so their common prefix won't change, except for truncation by the ending stop sequence
+    def __init__(self, callback):
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.committed = []
+        self.live = {}
+
+    def reset(self, stories):
+        with self.lock:
+            self.live = {id(story): [story] for story in stories}
+            self._advance()
+
+    def update(self, source_story, stories):
+        with self.lock:
+            self.live[id(source_story)] = list(stories)
+            self._advance()
+
+    def committed_text(self):
+        return ''.join([passage.text for passage in self.committed])
+
+    def _advance(self):
+        # only the passages past the committed prefix are compared, walking back from each story's end, so this
+        # costs the length of the uncommitted suffix rather than the whole story
+        num_committed = len(self.committed)
+        passage_sequences = [story.last_passages(story.num_passages() - num_committed) for stories in self.live.values() for story in stories]
+        if len(passage_sequences) == 0:
+            return
+        new_passages = []
+        i = 0
+        while all([len(passages) > i and passages[i] is passage_sequences[0][i] for passages in passage_sequences]):
+            new_passages.append(passage_sequences[0][i])
+            i += 1
+        if len(new_passages) > 0:
+            self.committed += new_passages
+            self.callback({'type': 'passage_committed', 'passages': new_passages, 'text': ''.join([passage.text for passage in new_passages])})
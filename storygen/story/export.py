@@ -0,0 +1,111 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+import threading
+import time
+import uuid
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from storygen.common.llm.scheduler import estimate_prompt_tokens
+
+
+# columnar export of generated stories: one row per passage, both the passages of the final story and (optionally) the
+# candidates that were scored and rejected along the way. each story is appended as its own parquet file to a dataset
+# partitioned by run_date, so a corpus can be built up across runs and read with e.g.
+# pyarrow.dataset.dataset(path, partitioning='hive') or pandas.read_parquet(path), without unpickling anything.
+
+SCORE_COLUMNS = ['length_score', 'coherence_score', 'relevance_score', 'commentary_score', 'score']
+
+PASSAGE_SCHEMA = pa.schema(
+    [
+        ('run_id', pa.string()),
+        ('story_id', pa.string()),
+        ('node_id', pa.string()),
+        ('node_depth', pa.int32()),
+        ('passage_index', pa.int32()), # position in the story (for candidates, the position they competed for)
+        ('selected', pa.bool_()), # whether the passage is in the final story
+        ('text', pa.string()),
+        ('finish_reason', pa.string()),
+        ('num_tokens', pa.int32()),
+        ('num_tokens_estimated', pa.bool_()), # the server didn't report per-candidate tokens, so num_tokens is from the text length
+        ('pruned', pa.bool_()), # dropped by cascade scoring before the LLM scorers ran, so it has no LLM scores or total score
+    ] + [(column, pa.float64()) for column in SCORE_COLUMNS] + [
+        ('run_date', pa.string()), # partition key
+    ]
+)
+
+
+def new_run_id():
+    return time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:8]
+
+
+class CandidateCollector:
+    # collects every scored candidate of a story from its candidates_scored events, to export alongside the final story.
+    # pass on_event as generate_story's event_callback
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.candidates = [] # (passage, outline node, passage index)
+
+    def on_event(self, event):
+        if event['type'] == 'candidates_scored':
+            candidates = [(passage, event['node'], event['story'].num_passages()) for passage in event['passages']]
+            with self.lock:
+                self.candidates += candidates
+
+
+def passage_rows(story, story_id, run_id, candidates=()):
+    # rows for the story's passages, then for the candidates that didn't make it into the story
+    rows = []
+    selected = set()
+    selected_texts = {} # (passage index, node id) -> texts of the selected passage, before and after any truncation
+    passage_index = 0
+    for passage_list in story.passage_lists:
+        for passage in passage_list.passages:
+            rows.append((passage, passage_list.outline_node, passage_index, True))
+            # the ending's stop sequence replaces the final passage with a truncated copy, so match its candidate too
+            selected.update([id(passage)] + ([id(passage.source)] if passage.source is not None else []))
+            selected_texts[(passage_index, passage_list.outline_node.id)] = {passage.text} | ({passage.source.text} if passage.source is not None else set())
+            passage_index += 1
+    for passage, node, passage_index in candidates:
+        # other samples of the selected passage's exact text are the same passage, not a rejected alternative
+        if id(passage) not in selected and passage.text not in selected_texts.get((passage_index, node.id), ()):
+            rows.append((passage, node, passage_index, False))
+    # no passage may appear both selected and unselected at the same position
+    assert not any([not is_selected and passage.text in selected_texts.get((passage_index, node.id), ()) for passage, node, passage_index, is_selected in rows])
+
+    run_date = run_id.split('-')[0]
+    columns = {name: [] for name in PASSAGE_SCHEMA.names}
+    for passage, node, passage_index, is_selected in rows:
+        aux_info = passage.aux_info
+        columns['run_id'].append(run_id)
+        columns['story_id'].append(story_id)
+        columns['node_id'].append(node.id)
+        columns['node_depth'].append(node.depth())
+        columns['passage_index'].append(passage_index)
+        columns['selected'].append(is_selected)
+        columns['text'].append(passage.text)
+        columns['finish_reason'].append(passage.finish_reason)
+        columns['num_tokens'].append(passage.num_tokens if passage.num_tokens is not None else estimate_prompt_tokens(passage.text))
+        columns['num_tokens_estimated'].append(passage.num_tokens is None)
+        pruned = bool(aux_info.get('pruned', False))
+        columns['pruned'].append(pruned)
+        for column in SCORE_COLUMNS:
+            # a pruned candidate's score is only the upper bound it was pruned on
+            columns[column].append(None if pruned and column == 'score' else aux_info.get(column, None))
+        columns['run_date'].append(run_date)
+    return pa.Table.from_pydict(columns, schema=PASSAGE_SCHEMA)
+
+
+def export_story(dataset_path, story, story_id, run_id, candidates=()):
+    # append the story's rows to the dataset as a new file; existing files, including other runs', are left alone
+    table = passage_rows(story, story_id, run_id, candidates=candidates)
+    ds.write_dataset(
+        table,
+        dataset_path,
+        format='parquet',
+        partitioning=ds.partitioning(pa.schema([('run_date', pa.string())]), flavor='hive'),
+        basename_template=f'{run_id}-{uuid.uuid4().hex[:8]}-{{i}}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+    )
+    return table.num_rows
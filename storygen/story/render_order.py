@@ -0,0 +1,66 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+
+
+class RenderOrder:
+    # the order in which a rendering policy renders the outline's nodes, precomputed once per plan. stories always
+    # render a prefix of this order, so the number of nodes a story has rendered is its cursor into it
+    def __init__(self, outline, rendering_policy):
+        self.outline = outline
+        if rendering_policy == 'all':
+            self.nodes = list(outline.depth_first_traverse())
+        elif rendering_policy == 'leaves':
+            self.nodes = outline.leaves()
+        else:
+            raise NotImplementedError
+        self.position = {node.id: i for i, node in enumerate(self.nodes)}
+        # render position of the last leaf under each node. leaves are rendered in story order under either policy,
+        # so a node's leaves have all been rendered exactly when the cursor is past its last one
+        self.last_leaf_position = {}
+        for node in reversed(list(outline.depth_first_traverse())): # children before parents
+            if len(node.children) == 0:
+                self.last_leaf_position[node.id] = self.position[node.id]
+            else:
+                self.last_leaf_position[node.id] = self.last_leaf_position[node.children[-1].id]
+
+    def next_node(self, num_rendered):
+        if num_rendered >= len(self.nodes):
+            raise StopIteration
+        return self.nodes[num_rendered]
+
+    def previous_nodes(self, num_rendered, n):
+        # the last n of the first num_rendered nodes
+        return self.nodes[max(0, num_rendered - n):num_rendered]
+
+    def upcoming_nodes(self, num_rendered, n):
+        # the next n nodes to render after the first num_rendered
+        return self.nodes[num_rendered:num_rendered + n]
+
+    def collapsed_nodes(self, num_rendered):
+        # the largest non-root outline nodes whose leaves are all among the first num_rendered nodes, in story order
+        return [node for node, finished in self.summary_frontier(num_rendered) if finished]
+
+    def summary_frontier(self, num_rendered):
+        # the nodes that together cover the first num_rendered nodes, in story order, as (node, whether its whole
+        # subtree is rendered) pairs: the collapsed nodes, plus any unfinished node that was rendered itself (under the
+        # "all" policy), just before its finished children. finished siblings always precede unfinished ones, so this
+        # only descends into one unfinished node per level
+        frontier = []
+        children = self.outline.children
+        while len(children) > 0:
+            next_children = []
+            for child in children:
+                if self.last_leaf_position[child.id] < num_rendered:
+                    frontier.append((child, True))
+                else:
+                    if self.position.get(child.id, num_rendered) < num_rendered:
+                        frontier.append((child, False))
+                    next_children = child.children
+                    break
+            children = next_children
+        return frontier
+
+def get_render_order(plan, rendering_policy):
+    # cached on the plan, since the outline doesn't change while a story is rendered
+    if rendering_policy not in plan.render_orders:
+        plan.render_orders[rendering_policy] = RenderOrder(plan.outline, rendering_policy)
+    return plan.render_orders[rendering_policy]
@@ -1,20 +1,66 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 
+from array import array
 from collections.abc import Sequence
 
+
+score_keys = {} # interned tuples of aux_info keys, so passages scored the same way share one
+
+
 class Passage:
-    def __init__(self, text, aux_info=None):
+    # scores are kept as a tuple of keys shared between passages plus a typed array of values, rather than a dict
+    # of float objects per passage; aux_info rebuilds the dict on access
+    __slots__ = ('text', 'score_keys', 'scores', 'id', 'finish_reason', 'num_tokens', 'source')
+
+    def __init__(self, text, aux_info=None, id=None, finish_reason=None, num_tokens=None, source=None):
         self.text = text
         self.aux_info = aux_info if aux_info is not None else {}
+        self.id = id # assigned when first written to a checkpoint log
+        self.finish_reason = finish_reason # as reported by the server for this candidate, if known
+        self.num_tokens = num_tokens # completion tokens, if the server reported them per candidate
+        self.source = source # the candidate this passage was truncated from, if any; not pickled
+
+    @property
+    def aux_info(self):
+        # a new dict each time, so assign aux_info to change scores rather than editing the result
+        return dict(zip(self.score_keys, self.scores))
+
+    @aux_info.setter
+    def aux_info(self, aux_info):
+        keys = tuple(aux_info.keys())
+        self.score_keys = score_keys.setdefault(keys, keys)
+        self.scores = array('d', [aux_info[key] for key in keys])
+
+    def aux_attr(self, attr):
+        try:
+            return self.scores[self.score_keys.index(attr)]
+        except ValueError:
+            raise KeyError(attr)
+
+    def __getstate__(self):
+        return {'text': self.text, 'aux_info': self.aux_info, 'id': self.id, 'finish_reason': self.finish_reason, 'num_tokens': self.num_tokens}
+
+    def __setstate__(self, state):
+        self.__init__(state['text'], state['aux_info'], state['id'], state.get('finish_reason', None), state.get('num_tokens', None))
     
     def __str__(self):
         return self.text
 
 
 class OutlineNodePassageList:
+    # passages are a tuple, since passage lists are shared between stories and never modified once created
+    __slots__ = ('outline_node', 'passages')
+
     def __init__(self, outline_node, passages=None):
         self.outline_node = outline_node
-        self.passages = passages if passages is not None else []
+        self.passages = tuple(passages) if passages is not None else ()
+
+    def __getstate__(self):
+        return {'outline_node': self.outline_node, 'passages': self.passages}
+
+    def __setstate__(self, state):
+        # also loads pickles from before __slots__, whose state was the instance dict
+        self.__init__(state['outline_node'], state['passages'])
     
     def __len__(self):
         return len(self.passages)
@@ -22,60 +68,159 @@ class OutlineNodePassageList:
     def __str__(self):
         return ''.join([str(passage) for passage in self.passages])
     
-    def append(self, passage):
-        self.passages.append(passage)
-    
     def aux_attr_list(self, attr):
-        return [passage.aux_info[attr] for passage in self.passages]
+        return [passage.aux_attr(attr) for passage in self.passages]
+
+
+class StoryCell:
+    # one outline node's passage list in a persistent linked list of passage lists. cells are never modified
+    # once created, apart from lazily cached values, so stories that differ only in their final node share everything before it.
+    __slots__ = ('passage_list', 'prev', 'num_lists', 'num_passages', 'prefix_text', 'id', 'summary', 'folded_summaries', 'summary_context')
+
+    def __init__(self, passage_list, prev, prefix_text=None, id=None):
+        self.passage_list = passage_list
+        self.prev = prev
+        self.num_lists = 1 + (prev.num_lists if prev is not None else 0)
+        self.num_passages = len(passage_list) + (prev.num_passages if prev is not None else 0)
+        self.prefix_text = prefix_text # lazily cached text of all passage lists before this one
+        self.id = id # assigned when first written to a checkpoint log
+        # hierarchical summaries, filled in once the node is finished: the summary of this node's text, the folded
+        # summaries of the subtrees this node finishes (by node id), and the summaries covering the story up through here
+        self.summary = None
+        self.folded_summaries = {}
+        self.summary_context = None
+
+
+class PassageListView(Sequence):
+    # read-only view of a story's passage lists; indexing from the end (e.g. [-1], [-2]) is O(|index|)
+    def __init__(self, tail):
+        self.tail = tail
+
+    def __len__(self):
+        return self.tail.num_lists if self.tail is not None else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('passage list index out of range')
+        cell = self.tail
+        for _ in range(len(self) - 1 - index):
+            cell = cell.prev
+        return cell.passage_list
+
+    def __iter__(self):
+        passage_lists = []
+        cell = self.tail
+        while cell is not None:
+            passage_lists.append(cell.passage_list)
+            cell = cell.prev
+        return reversed(passage_lists)
 
 
 class Story:
     def __init__(self, plan, passage_lists=None):
         self.plan = plan
-        self.passage_lists = passage_lists if passage_lists is not None else []
+        self.tail = None
+        for passage_list in (passage_lists if passage_lists is not None else []):
+            self.tail = StoryCell(passage_list, self.tail)
+
+    @staticmethod
+    def from_tail(plan, tail):
+        story = Story(plan)
+        story.tail = tail
+        return story
+
+    def __getstate__(self):
+        # flatten the linked cells so pickling doesn't recurse once per outline node
+        return {'plan': self.plan, 'passage_lists': list(self.passage_lists)}
+
+    def __setstate__(self, state):
+        self.__init__(state['plan'], state['passage_lists'])
+
+    @property
+    def passage_lists(self):
+        return PassageListView(self.tail)
     
     def __len__(self):
-        return len(self.passage_lists)
-        # return sum([len(passage_list) for passage_list in self.passage_lists])
+        return self.tail.num_lists if self.tail is not None else 0
     
     def __str__(self):
-        return ''.join([str(passage_list) for passage_list in self.passage_lists])
+        if self.tail is None:
+            return ''
+        return self._prefix_text(self.tail) + str(self.tail.passage_list)
+
+    def _prefix_text(self, cell):
+        # walk back to the nearest cell with cached prefix text, then build forward from it. only the requested
+        # cell caches its result, so repeated calls are cheap without keeping a copy of the text for every node
+        cells = []
+        while cell.prefix_text is None and cell.prev is not None:
+            cells.append(cell)
+            cell = cell.prev
+        text = cell.prefix_text if cell.prefix_text is not None else ''
+        for uncached_cell in reversed(cells):
+            text += str(uncached_cell.prev.passage_list)
+        if len(cells) > 0:
+            cells[0].prefix_text = text
+        return text
     
     def save(self, path):
         with open(path, 'w') as f:
             f.write(str(self))
     
     def copy_append_list(self, passage_list):
-        return Story(self.plan, self.passage_lists + [passage_list])
+        return Story.from_tail(self.plan, StoryCell(passage_list, self.tail))
     
     def copy_append_passage(self, passage):
-        return Story(self.plan, self.passage_lists[:-1] + [OutlineNodePassageList(self.passage_lists[-1].outline_node, self.passage_lists[-1].passages + [passage])])
+        # only the final node's (short) passage list is copied; the cached prefix text carries over since the prefix is unchanged
+        passage_list = OutlineNodePassageList(self.tail.passage_list.outline_node, self.tail.passage_list.passages + (passage,))
+        return Story.from_tail(self.plan, StoryCell(passage_list, self.tail.prev, prefix_text=self.tail.prefix_text))
     
     def rendered_nodes(self):
         return [passage_list.outline_node for passage_list in self.passage_lists]
     
     def final_passage_aux_attr(self, attr):
-        return self.passage_lists[-1].passages[-1].aux_info[attr]
+        return self.tail.passage_list.passages[-1].aux_attr(attr)
+
+    def num_passages(self):
+        return self.tail.num_passages if self.tail is not None else 0
+
+    def last_passages(self, k):
+        # the last k passages in order, in O(k) plus the number of empty passage lists skipped
+        passages = []
+        cell = self.tail
+        while cell is not None and len(passages) < k:
+            passages = list(cell.passage_list.passages[-(k - len(passages)):]) + passages
+            cell = cell.prev
+        return passages
 
     def passages(self):
         return [passage for passage_list in self.passage_lists for passage in passage_list.passages]
     
     def right_truncate(self, stop, allow_delete_passage_lists=False):
-        # truncate passages from the right until we see the stop sequence
-        for i in range(len(self.passage_lists) - 1, -1, -1):
-            for j in range(len(self.passage_lists[i].passages) - 1, -1, -1):
-                if stop in self.passage_lists[i].passages[j].text:
-                    self.passage_lists[i].passages[j].text = stop.join(self.passage_lists[i].passages[j].text.split(stop)[:-1])
+        # truncate passages from the right until we see the stop sequence. passages and passage lists can be shared
+        # with other stories, so the affected ones are replaced rather than edited in place
+        passage_lists = list(self.passage_lists)
+        for i in range(len(passage_lists) - 1, -1, -1):
+            passages = passage_lists[i].passages
+            for j in range(len(passages) - 1, -1, -1):
+                if stop in passages[j].text:
+                    truncated_passage = Passage(stop.join(passages[j].text.split(stop)[:-1]), passages[j].aux_info, finish_reason=passages[j].finish_reason, source=passages[j].source or passages[j])
+                    passage_lists[i] = OutlineNodePassageList(passage_lists[i].outline_node, passages[:j] + (truncated_passage,))
+                    self.__init__(self.plan, passage_lists)
                     return self
-                else:
-                    # delete this passage
-                    self.passage_lists[i].passages = self.passage_lists[i].passages[:j]
+            # delete all passages in this list
+            passage_lists[i] = OutlineNodePassageList(passage_lists[i].outline_node)
             if allow_delete_passage_lists:
                 # delete this passage list
-                self.passage_lists = self.passage_lists[:i]
+                passage_lists = passage_lists[:i]
             else:
                 # stop here even though we didn't find the stop sequence
-                return self
+                break
+        self.__init__(self.plan, passage_lists)
+        return self
 
 
 class StoryBeam(Sequence):
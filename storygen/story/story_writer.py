@@ -1,75 +1,147 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 
-from copy import deepcopy
+import hashlib
 import logging
-import os
-import pickle
+import queue
+import threading
 
+from storygen.common.cache import ComputeCache
+from storygen.common.concurrency import concurrent_map
+from storygen.common.llm.prompt import overlay_prompts
+from storygen.common.trace import span, traced
 from storygen.plan.outline import *
+from storygen.story.adaptive import AdaptiveCandidateCount
+from storygen.story.budget import StoryBudget
+from storygen.story.checkpoint import *
+from storygen.story.events import *
+from storygen.story.render_order import *
 from storygen.story.story import *
 
 
-def generate_story(plan, story_config, story_prompts, llm_client, intermediate_save_prefix=None, delete_old_intermediates=True):
-    beam = StoryBeam([Story(plan)])
-    step = 0
-    if intermediate_save_prefix is not None:
-        # load from save if it exists
-        for i in range(len([n for n in plan.outline.depth_first_traverse()])): # assume max num steps is num nodes in plan
+@traced()
+def generate_story(plan, story_config, story_prompts, llm_client, checkpoint_path=None, checkpoint_passages=True, delete_checkpoint=True, event_callback=None, usage=None, checkpoint_store=None):
+    if story_config.get('prompt_assembly', 'default') == 'stable-prefix':
+        # alternate prompts ordering their sections from most to least stable, for server-side prefix caching
+        story_prompts = overlay_prompts(story_prompts, story_prompts['stable_prefix'])
+    # this story's own LLM usage, which the client's usage doesn't separate out when it's shared
+    usage = usage if usage is not None else Usage()
+    with track_usage(usage):
+        summary_cache = ComputeCache()
+        score_cache = ComputeCache(max_size=story_config['score'].get('cache_size', None))
+        beam = StoryBeam([Story(plan)])
+        step = 0
+        checkpoint_log = None
+        if checkpoint_path is not None:
+            # resume from the checkpoint log if it exists
+            checkpoint_log = StoryCheckpointLog(checkpoint_path, plan, store=checkpoint_store)
+            if checkpoint_log.load_beam() is not None:
+                beam = checkpoint_log.load_beam()
+                step = checkpoint_log.latest_beam['step'] + 1
+                logging.info(f"Resuming story from checkpoint {checkpoint_path} after {step} nodes")
+        budget = StoryBudget(story_config.get('budget', None), usage)
+        candidate_count = AdaptiveCandidateCount(story_config['passage']) if story_config['passage'].get('adaptive_n', False) else None
+        num_nodes = len(get_render_order(plan, story_config['rendering_policy']).nodes)
+
+        on_event = None
+        if event_callback is not None:
+            # passages are reported as committed once every live story agrees on them
+            commit_tracker = StoryCommitTracker(event_callback)
+            commit_tracker.reset(beam)
+            def on_event(event):
+                if event['type'] == 'beam_pruned' and event['source'] is not None:
+                    commit_tracker.update(event['source'], event['stories'])
+                event_callback(event)
+
+        while True:
             try:
-                with open(f'{intermediate_save_prefix}_{i}.pkl', 'rb') as f:
-                    beam = pickle.load(f)
-                logging.info(f"Loaded intermediate save: {intermediate_save_prefix}_{i}.pkl")
-                step = i+1
+                node_to_render = select_node_to_render(plan, beam, story_config)
+                logging.info(f"Rendering node: {node_to_render.text}")
+            except StopIteration:
                 break
-            except:
-                continue
+            emit_event({'event_callback': on_event}, 'node_started', node=node_to_render, step=step)
+            budget.update(step / num_nodes)
+            node_config = budget.apply(story_config)
+            def render_beam_member(beam_index, story):
+                with span('render_node', node=step, beam_index=beam_index):
+                    return render_node(story, node_to_render, node_config, story_prompts, llm_client, summary_cache=summary_cache, score_cache=score_cache, checkpoint_log=checkpoint_log, checkpoint_passages=checkpoint_passages, event_callback=on_event, budget=budget, candidate_count=candidate_count)
+            next_story_candidates = []
+            with span('node', node=step, text=node_to_render.text):
+                for rendered_beam in concurrent_map(lambda item: render_beam_member(*item), enumerate(beam)):
+                    next_story_candidates += rendered_beam.stories
+                beam = filter_beam(StoryBeam(next_story_candidates), beam_width=node_config['outline_node_beam_width'], aux_attr='score')
+            emit_event({'event_callback': on_event}, 'beam_pruned', node=node_to_render, source=None, num_candidates=len(next_story_candidates), stories=beam.stories)
+            if event_callback is not None:
+                commit_tracker.reset(beam)
+            if node_config['previous_summary_context'] == 'hierarchical':
+                # summarize the node just rendered, and fold any subtrees it finishes, once per distinct story
+                with span('summarize_node', node=step):
+                    concurrent_map(lambda story: hierarchical_summary_context(story.tail, story, node_config, story_prompts, llm_client, summary_cache=summary_cache), list({id(story.tail): story for story in beam}.values()))
+            # only the summaries of the node just rendered can be needed again
+            summary_cache.retain({str(story.passage_lists[-1]) for story in beam})
 
-    while True:
-        try:
-            node_to_render = select_node_to_render(plan, beam, story_config)
-            logging.info(f"Rendering node: {node_to_render.text}")
-        except StopIteration:
-            if delete_old_intermediates:
-                try:
-                    os.remove(f'{intermediate_save_prefix}_{step-1}.pkl')
-                except:
-                    pass
-            break
-        next_story_candidates = []
-        for story in beam:
-            next_story_candidates += render_node(story, node_to_render, story_config, story_prompts, llm_client).stories
-        beam = filter_beam(StoryBeam(next_story_candidates), beam_width=story_config['outline_node_beam_width'], aux_attr='score')
-
-        logging.debug(f"Best story: {str(beam.stories[0])}")
-
-        if intermediate_save_prefix is not None:
-            with open(f'{intermediate_save_prefix}_{step}.pkl', 'wb') as f:
-                pickle.dump(beam, f)
-            if delete_old_intermediates:
-                try:
-                    os.remove(f'{intermediate_save_prefix}_{step-1}.pkl')
-                except:
-                    pass
-        step += 1
+            logging.debug("Best story: %s", beam.stories[0])
+
+            if checkpoint_log is not None:
+                checkpoint_log.log_beam(beam, step)
+            step += 1
         
-    beam = end_story(beam, plan, story_config, story_prompts, llm_client)
-    logging.debug(f"Best story: {str(beam.stories[0])}")
-    return beam
+        budget.update(1)
+        beam = end_story(beam, plan, budget.apply(story_config), story_prompts, llm_client, summary_cache=summary_cache, score_cache=score_cache, event_callback=on_event, budget=budget, candidate_count=candidate_count)
+        logging.debug("Best story: %s", beam.stories[0])
+        logging.info(f"Summary cache: {summary_cache}")
+        logging.info(f"Scorer cache: {score_cache}")
+        logging.info(f"Story usage: {usage}")
+        if checkpoint_log is not None and delete_checkpoint:
+            checkpoint_log.delete()
+        # the ending may have truncated text that was already reported as committed, so consumers should take the final text from here
+        emit_event({'event_callback': event_callback}, 'story_finished', beam=beam)
+        return beam
+
+
+class StoryCancelled(Exception):
+    pass
+
+
+def stream_story(plan, story_config, story_prompts, llm_client, **kwargs):
+    # generator version of generate_story, yielding its events as they happen and ending with 'story_finished'.
+    # generation runs in a background thread; exceptions are re-raised here. if the consumer stops early (breaks out,
+    # or the generator is closed or garbage collected), the next event raises StoryCancelled in the generating thread,
+    # so it stops within a passage step instead of finishing the story with nobody reading
+    events = queue.Queue()
+    done = object()
+    error = []
+    cancelled = threading.Event()
+    def on_event(event):
+        if cancelled.is_set():
+            raise StoryCancelled()
+        events.put(event)
+    def run():
+        try:
+            generate_story(plan, story_config, story_prompts, llm_client, event_callback=on_event, **kwargs)
+        except StoryCancelled:
+            pass
+        except BaseException as e:
+            error.append(e)
+        finally:
+            events.put(done)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            event = events.get()
+            if event is done:
+                break
+            yield event
+    finally:
+        cancelled.set()
+    thread.join()
+    if len(error) > 0:
+        raise error[0]
 
 
 def select_node_to_render(plan, beam, story_config):
-    if story_config['rendering_policy'] == 'all':
-        for node in plan.outline.depth_first_traverse():
-            if node not in beam.rendered_nodes():
-                return node
-        raise StopIteration
-    elif story_config['rendering_policy'] == 'leaves':
-        for node in plan.outline.leaves():
-            if node not in beam.rendered_nodes():
-                return node
-        raise StopIteration
-    else:
-        raise NotImplementedError
+    # all stories in the beam have rendered the same prefix of the render order
+    return get_render_order(plan, story_config['rendering_policy']).next_node(len(beam.stories[0]) if len(beam) > 0 else 0)
 
 
 def render_node(story, node_to_render, story_config, story_prompts, llm_client, **kwargs):
@@ -87,21 +159,37 @@ def render_node(story, node_to_render, story_config, story_prompts, llm_client,
             stories_with_scores = sorted(stories_with_scores, key=lambda x: x[1], reverse=True)
             best_stories = StoryBeam([story for story, _ in stories_with_scores[:story_config['passage_beam_width']]])
             return best_stories
+    source_story = story
     node_passage_list = OutlineNodePassageList(node_to_render)
     story = story.copy_append_list(node_passage_list)
     beam = StoryBeam([story])
     best_stories = StoryBeam([story])
-    for i in range(story_config['max_passages_per_node']):
+    start_step = 0
+    checkpoint_log = kwargs.get('checkpoint_log', None)
+    if checkpoint_log is not None:
+        # pick up from the last passage step checkpointed for this node, if we crashed partway through it
+        progress = checkpoint_log.load_node_progress(node_to_render, source_story)
+        if progress is not None:
+            passage_step, beam, best_stories = progress
+            start_step = passage_step + 1
+            logging.info(f"Resuming node {node_to_render.text} after {start_step} passage steps")
+    for i in range(start_step, story_config['max_passages_per_node']):
+        # no need to continue generating for story candidates that have already ended generation for this node
+        active_stories = [story for story in beam if i <= len(story.passage_lists[-1])]
+        def render_passage_beam_member(beam_index, story):
+            with span('render_passage', passage_step=i, beam_index=beam_index):
+                return render_passage(story, node_to_render, story_config, story_prompts, llm_client, **kwargs)
         updated_stories = []
-        for story in beam:
-            if i > len(story.passage_lists[-1]):
-                # no need to continue generating for story candidates that have already ended generation for this node
-                continue
-            passages = render_passage(story, node_to_render, story_config, story_prompts, llm_client, **kwargs)
+        for story, passages in zip(active_stories, concurrent_map(lambda item: render_passage_beam_member(*item), enumerate(active_stories))):
             for passage in passages:
                 updated_stories.append(story.copy_append_passage(passage))
         beam = filter_beam(StoryBeam(updated_stories), beam_width=story_config['passage_beam_width'], aux_attr='score')
         best_stories = update_best_stories(i, best_stories, beam, story_config)
+        emit_event(kwargs, 'beam_pruned', node=node_to_render, source=source_story, num_candidates=len(updated_stories), stories=beam.stories + best_stories.stories)
+        if checkpoint_log is not None and kwargs.get('checkpoint_passages', False) and i < story_config['max_passages_per_node'] - 1:
+            checkpoint_log.log_node_progress(node_to_render, source_story, i, beam, best_stories)
+        if kwargs.get('budget', None) is not None and i + 1 >= story_config['min_passages_per_node'] and kwargs['budget'].exhausted():
+            break
     return best_stories
 
 
@@ -113,7 +201,7 @@ def render_passage(story, node_to_render, story_config, story_prompts, llm_clien
 
     # entity descriptions to include in context
     if len(story.passage_lists) >= 2 and story_config.get('previous_node_entity_descriptions', False):
-        entities_to_describe = story.passage_lists[-2].outline_node.entities
+        entities_to_describe = list(story.passage_lists[-2].outline_node.entities)
         for entity in node_to_render.entities:
             if entity not in entities_to_describe:
                 entities_to_describe.append(entity)
@@ -127,9 +215,7 @@ def render_passage(story, node_to_render, story_config, story_prompts, llm_clien
     else:
         if story_config['collapse_previous_events']:
             # for all previous nodes which can be collapsed into their parents, collapse them to save context window space
-            all_previous_nodes = set(story.rendered_nodes()[:-1])
-            all_collapsed_ancestors = [node for node in story.plan.outline.depth_first_traverse(include_self=False) if all([n in all_previous_nodes for n in node.leaves()])]
-            previous_nodes = [node for node in all_collapsed_ancestors if node.parent is not None and node.parent not in all_collapsed_ancestors]
+            previous_nodes = get_render_order(story.plan, story_config['rendering_policy']).collapsed_nodes(len(story) - 1)
         else:
             previous_nodes = story.rendered_nodes()[:-1]
         previous_node_events = ' '.join([node.text for node in previous_nodes])
@@ -140,48 +226,32 @@ def render_passage(story, node_to_render, story_config, story_prompts, llm_clien
         previous_scene_info = f' The setting is previously {story.passage_lists[-2].outline_node.scene}'
         
     # summary of previous context
-    if story_config['previous_summary_context'] == 'previous-node':
-        if len(story.passage_lists) < 2:
-            previous_summary = 'N/A'
-        else:
-            raw_context = str(story.passage_lists[-2])
-            previous_summary = llm_client.call_with_retry(
-                story_prompts['summary'].format(
-                    raw_context=raw_context
-                ),
-                SamplingConfig.from_config(story_config['summary']),
-                filter=min_max_tokens_filter(0, story_config['summary']['max_tokens'])
-            )[0]
+    if len(story.passage_lists) < 2:
+        previous_summary = 'N/A'
+    elif story_config['previous_summary_context'] == 'previous-node':
+        raw_context = str(story.passage_lists[-2])
+        previous_summary = summarize_text(story_prompts['summary'].format(raw_context=raw_context), raw_context, story_config, llm_client, summary_cache=kwargs.get('summary_cache', None))
+    elif story_config['previous_summary_context'] == 'hierarchical':
+        # everything before the current node, as the summaries of its finished nodes folded up the outline
+        previous_summary = ' '.join(hierarchical_summary_context(story.tail.prev, story, story_config, story_prompts, llm_client, summary_cache=kwargs.get('summary_cache', None)))
     else:
         raise NotImplementedError
     
     # TODO fix spacing to LLaMA tokenizer removing spacing at beginning
     # any previous events to include in description of upcoming
-    previous_events = ''
-    previous_nodes = reversed(story.rendered_nodes()[:-1])
-    for i in range(story_config['include_previous_events']):
-        if i >= len(previous_nodes):
-            break
-        previous_events = previous_nodes[i].text + ' ' + previous_events
+    render_order = get_render_order(story.plan, story_config['rendering_policy'])
+    previous_events = ' '.join([node.text for node in render_order.previous_nodes(len(story) - 1, story_config['include_previous_events'])])
     if len(previous_events) > 0:
         previous_events = previous_events + ' '
     
     # any future events to include in description of upcoming
-    future_events = ''
-    future_story = story
-    for i in range(story_config['include_next_events']):
-        try:
-            next_node = select_node_to_render(future_story.plan, future_story, story_config) # technically this is only guessing based on empty passages
-            future_events += next_node.text + ' '
-            future_story = future_story.copy_append_list(OutlineNodePassageList(next_node))
-        except StopIteration:
-            break
+    future_events = ' '.join([node.text for node in render_order.upcoming_nodes(len(story), story_config['include_next_events'])])
     if len(future_events) > 0:
-        future_events = ' ' + ' '.join(future_events)
+        future_events = ' ' + future_events
 
     # raw text for autoregressively continuing generation
     if story_config['autoregressive_context'] == 'current-node':
-        if len(story.passages()) == 0:
+        if story.num_passages() == 0:
             autoregressive_context = 'Chapter 1\n\n'
         elif len(story.passage_lists[-1].passages) == 0:
             autoregressive_context = story.passage_lists[-2].passages[-1].text # most recent passage if the current node is the first passage of a new node
@@ -195,6 +265,17 @@ def render_passage(story, node_to_render, story_config, story_prompts, llm_clien
     else:
         ending_info = ' This passage should end the story.'
     
+    # candidates failing this are dropped before scoring, so they never cost scorer calls
+    bad_strings = ['passage']
+    similarity_filter = levenshtein_ratio_filter([passage.text for passage in story.last_passages(1)])
+    passage_filter = Filter(lambda s: len(s.strip()) > 0 and not any([bad_string.lower() in s.lower() for bad_string in bad_strings])) + similarity_filter
+    # the parts of the filter that can already fail on a prefix of the text, so streamed candidates can be cut off early.
+    # the similarity filter compares word by word, so it's checked on the words that are already complete
+    doomed = lambda partial_text: any([bad_string.lower() in partial_text.lower() for bad_string in bad_strings]) or \
+                not similarity_filter(' '.join(partial_text.split()[:-1]))
+    passage_sampling_config = SamplingConfig.from_config(story_config['passage'])
+    if kwargs.get('candidate_count', None) is not None:
+        passage_sampling_config.n = kwargs['candidate_count'].next_n(story_config['passage'])
     passages = llm_client.call_with_retry(
         story_prompts['passage'].format(
             premise=story.plan.premise.premise,
@@ -211,112 +292,313 @@ def render_passage(story, node_to_render, story_config, story_prompts, llm_clien
             autoregressive_context=autoregressive_context,
             ending_info=ending_info
         ),
-        SamplingConfig.from_config(story_config['passage']),
+        passage_sampling_config,
         postprocessor=partial(make_and_score_passages, 
                             story=story, 
                             node=node_to_render, 
                             story_config=story_config, 
                             story_prompts=story_prompts, 
                             llm_client=llm_client,
-                            is_ending=kwargs.get('is_ending', False)
+                            passage_filter=passage_filter,
+                            is_ending=kwargs.get('is_ending', False),
+                            score_cache=kwargs.get('score_cache', None),
+                            candidate_count=kwargs.get('candidate_count', None)
         ),
-        filter=Filter(lambda s: len(s.text.strip()) > 0 and not any([bad_string.lower() in s.text.lower() for bad_string in ['passage']])) + \
-                Filter.wrap_preprocessor(lambda s: s.text, levenshtein_ratio_filter([story.passages()[-1].text] if len(story.passages()) > 0 else [])),
-        empty_ok=True
+        filter=lambda passage: True, # already filtered by make_and_score_passages
+        empty_ok=True,
+        priority='high', # passages are on the story's critical path
+        doomed=doomed,
+        stage='passage'
     )
+    emit_event(kwargs, 'candidates_scored', node=node_to_render, story=story, passages=passages)
     return passages
 
 
-def make_and_score_passages(raw_passages, story, node, story_config, story_prompts, llm_client, full_completion_object=None, **kwargs):
+def summarize_text(prompt, cache_key, story_config, llm_client, summary_cache=None):
+    summarize = lambda: llm_client.call_with_retry(
+        prompt,
+        SamplingConfig.from_config(story_config['summary']),
+        filter=min_max_tokens_filter(0, story_config['summary']['max_tokens']),
+        stage='summary'
+    )[0]
+    # the text being summarized is fixed by now, so every passage step and beam member sharing it can reuse one summary
+    with span('summary'):
+        if summary_cache is not None:
+            return summary_cache.get_or_compute(cache_key, summarize)
+        return summarize()
+
+
+def summarize_finished_cell(cell, render_order, story_config, story_prompts, llm_client, summary_cache=None):
+    # summarize a finished node's text, fold the summaries of every subtree it finishes into their roots' summaries
+    # (deepest first), and record the summaries that cover the story up through it. earlier cells must be done already
+    position = cell.num_lists - 1
+    node = cell.passage_list.outline_node
+    cells = {}
+    earlier_cell = cell
+    def cell_at(cell_position):
+        nonlocal earlier_cell
+        while cell_position not in cells:
+            cells[earlier_cell.num_lists - 1] = earlier_cell
+            earlier_cell = earlier_cell.prev
+        return cells[cell_position]
+    def subtree_summary(subtree_root):
+        last_leaf_cell = cell_at(render_order.last_leaf_position[subtree_root.id])
+        return last_leaf_cell.summary if len(subtree_root.children) == 0 else last_leaf_cell.folded_summaries[subtree_root.id]
+
+    raw_context = str(cell.passage_list)
+    cell.summary = summarize_text(story_prompts['summary'].format(raw_context=raw_context), raw_context, story_config, llm_client, summary_cache=summary_cache)
+    for ancestor in reversed(node.ancestors(include_self=True)):
+        if ancestor.parent is None or len(ancestor.children) == 0:
+            continue
+        if render_order.last_leaf_position[ancestor.id] != position:
+            break # ancestors further up can't have finished either
+        summaries = [cell_at(render_order.position[ancestor.id]).summary] if ancestor.id in render_order.position else []
+        summaries += [subtree_summary(child) for child in ancestor.children]
+        summaries = ' '.join(summaries)
+        cell.folded_summaries[ancestor.id] = summarize_text(story_prompts['summary_fold'].format(summaries=summaries), ('summary_fold', summaries), story_config, llm_client, summary_cache=summary_cache)
+
+    summary_context = []
+    frontier = render_order.summary_frontier(position + 1)
+    for frontier_node, finished in frontier:
+        summary_context.append(subtree_summary(frontier_node) if finished else cell_at(render_order.position[frontier_node.id]).summary)
+    if len(frontier) == 0 or frontier[-1][0] != node:
+        # the node's own summary was folded away, but the text right before the next passage is worth keeping in detail
+        summary_context.append(cell.summary)
+    cell.summary_context = tuple(summary_context)
+
+
+def hierarchical_summary_context(cell, story, story_config, story_prompts, llm_client, summary_cache=None):
+    # the summaries covering the story up through cell: at most a few per outline level, however long the story is.
+    # each finished node is summarized once, normally right after it's rendered; any cells missed (e.g. after resuming
+    # from a checkpoint) are summarized here, oldest first
+    render_order = get_render_order(story.plan, story_config['rendering_policy'])
+    unsummarized = []
+    earlier_cell = cell
+    while earlier_cell is not None and earlier_cell.summary_context is None:
+        unsummarized.append(earlier_cell)
+        earlier_cell = earlier_cell.prev
+    for unsummarized_cell in reversed(unsummarized):
+        summarize_finished_cell(unsummarized_cell, render_order, story_config, story_prompts, llm_client, summary_cache=summary_cache)
+    return cell.summary_context
+
+
+@traced()
+def make_and_score_passages(raw_passages, story, node, story_config, story_prompts, llm_client, full_completion_object=None, passage_filter=None, **kwargs):
     assert len(full_completion_object['choices']) == len(raw_passages)
-    passages = []
-    for passage_idx, passage_text in enumerate(raw_passages):
-        passage_text = passage_text.rstrip()
-        if story_config.get('include_prefix_space', False) and not passage_text.startswith(' '):
-            passage_text = ' ' + passage_text
-            passage_text = passage_text.replace('  ', ' ')
-        aux_info = {}
-        score = 0
-        for scorer in story_config['score']['scorers']:
-            if scorer == 'coherence':
-                coherence_score = 0
-                if len(story.passages()) > 0:
-                    try:
-                        coherence_prefix = story.passages()[-story_config['score']['coherence']['max_prefix_passages']:]
-                        coherence_prefix = ''.join([p.text for p in coherence_prefix])
-                        _, coherence_score_completion = llm_client.call_with_retry(
-                            story_prompts['score']['coherence'].format(
-                                prefix=coherence_prefix.strip(),
-                                continuation=passage_text.strip()
-                            ),
-                            SamplingConfig.from_config(story_config['score']['coherence']),
-                            filter=lambda s: len(s.strip()) > 0,
-                            return_full_completion=True
-                        )
-                        yes_no_logprobs = extract_choice_logprobs(coherence_score_completion, default_logprobs=[-1e8, -1e7])
-                        coherence_score = yes_no_logprobs[0][0] # logprob of yes
-                    except:
-                        logging.warning(f"Failed to score coherence for passage: {passage_text}")
-                        coherence_score = -1e10
-                score += coherence_score
-                aux_info['coherence_score'] = coherence_score
-            elif scorer == 'relevance':
-                try:
-                    _, relevance_score_completion = llm_client.call_with_retry(
-                        story_prompts['score']['relevance'].format(
-                            node_event=node.text.strip(),
-                            continuation=(''.join([p.text for p in story.passage_lists[-1].passages] + [passage_text])).strip(),
-                        ),
-                        SamplingConfig.from_config(story_config['score']['relevance']),
-                        filter=lambda s: len(s.strip()) > 0,
-                        return_full_completion=True
-                    )
-                    yes_no_logprobs = extract_choice_logprobs(relevance_score_completion, default_logprobs=[-1e8, -1e7])
-                    relevance_score = yes_no_logprobs[0][0] # logprob of yes
-                except:
-                    logging.warning(f"Failed to score relevance for passage: {passage_text}")
-                    relevance_score = -1e10
-                score += relevance_score
-                aux_info['relevance_score'] = relevance_score
-            elif scorer == 'commentary':
-                if any([s in passage_text for s in story_config['passage']['stop']]):
-                    commentary_score = -1e10
-                else:
-                    try:
-                        _, commentary_score_completion = llm_client.call_with_retry(
-                            story_prompts['score']['commentary'].format(
-                                last_paragraph=passage_text.rsplit('\n', 1)[-1].strip()
-                                # continuation=passage_text
-                            ),
-                            SamplingConfig.from_config(story_config['score']['commentary']),
-                            filter=lambda s: len(s.strip()) > 0,
-                            return_full_completion=True
-                        )
-                        story_commentary_logprobs = extract_choice_logprobs(commentary_score_completion, choices=['A', 'B'], default_logprobs=[-1e8, -1e7], case_sensitive=True)
-                        commentary_score = story_commentary_logprobs[0][0] # logprob of A (it's asking whether it's story or commentary; we want it to be a story)
-                        # yes_no_logprobs = extract_choice_logprobs(commentary_score_completion)
-                        # commentary_score = yes_no_logprobs[0][1] # logprob of no; we don't want commentary at the end
-                    except:
-                        logging.warning(f"Failed to score commentary for passage: {passage_text}")
-                        commentary_score = -1e10
-                score += commentary_score
-                aux_info['commentary_score'] = commentary_score
-            elif scorer == 'length':
-                length_score = 0
-                if full_completion_object['choices'][passage_idx]['finish_reason'] != 'length':
-                    if 'is_ending' in kwargs and kwargs['is_ending']:
-                        # we want to stop early when trying to end the story
-                        length_score = 100
-                    else:
-                        # penalize for not finishing due to length - we don't want things that stopped early instead of continuing in the story text style.
-                        length_score = -100
-                score += length_score
-                aux_info['length_score'] = length_score
-            else:
-                raise NotImplementedError
-        aux_info['score'] = score
-        passages.append(Passage(passage_text, aux_info))
-    return passages
+    passage_texts = [postprocess_passage_text(passage_text, story_config) for passage_text in raw_passages]
+    finish_reasons = [choice['finish_reason'] for choice in full_completion_object['choices']]
+    # per-candidate token counts are only known when the server returned logprobs
+    num_tokens = [len(choice['logprobs']['tokens']) if choice.get('logprobs', None) is not None else None for choice in full_completion_object['choices']]
+    kept_indices = [i for i, passage_text in enumerate(passage_texts) if passage_filter is None or passage_filter(passage_text)]
+    passage_texts = [passage_texts[i] for i in kept_indices]
+    finish_reasons = [finish_reasons[i] for i in kept_indices]
+    num_tokens = [num_tokens[i] for i in kept_indices]
+    # candidates that are identical up to whitespace get identical scores, so only score the first of each
+    candidate_keys = [(' '.join(passage_text.split()), finish_reason) for passage_text, finish_reason in zip(passage_texts, finish_reasons)]
+    unique_indices = []
+    for i, key in enumerate(candidate_keys):
+        if key not in candidate_keys[:i]:
+            unique_indices.append(i)
+    if len(unique_indices) < len(passage_texts):
+        logging.debug(f"Scoring {len(unique_indices)} distinct passages out of {len(passage_texts)} candidates")
+    score = lambda i, scorers=None, aux_info=None: score_passage(
+        passage_texts[i], 
+        finish_reasons[i], 
+        story, 
+        node, 
+        story_config, 
+        story_prompts, 
+        llm_client, 
+        is_ending=kwargs.get('is_ending', False), 
+        score_cache=kwargs.get('score_cache', None),
+        scorers=scorers,
+        aux_info=aux_info
+    )
+    multiplicities = [candidate_keys.count(candidate_keys[i]) for i in unique_indices]
+    if story_config['score'].get('cascade', False):
+        unique_aux_infos = cascade_score_passages(
+            unique_indices, 
+            multiplicities, 
+            score, 
+            lambda i: cheap_scores(passage_texts[i], finish_reasons[i], story, story_config, is_ending=kwargs.get('is_ending', False)), 
+            story_config
+        )
+    else:
+        # candidates are scored concurrently; results stay in sampling order
+        unique_aux_infos = concurrent_map(score, unique_indices)
+    aux_infos = {candidate_keys[i]: aux_info for i, aux_info in zip(unique_indices, unique_aux_infos)}
+    if kwargs.get('candidate_count', None) is not None and not kwargs.get('is_ending', False):
+        kwargs['candidate_count'].record(len(raw_passages), [aux_info['score'] for aux_info in unique_aux_infos], multiplicities, story_config['passage'])
+    return [Passage(passage_text, aux_infos[key], finish_reason=finish_reason, num_tokens=candidate_num_tokens) for passage_text, key, finish_reason, candidate_num_tokens in zip(passage_texts, candidate_keys, finish_reasons, num_tokens)]
+
+
+def cheap_scores(passage_text, finish_reason, story, story_config, is_ending=False):
+    # the scores that don't need an LLM call; returns them and the scorers that still need to run
+    aux_info = {}
+    remaining_scorers = []
+    for scorer in story_config['score']['scorers']:
+        if scorer == 'length':
+            aux_info['length_score'] = score_length(finish_reason, is_ending=is_ending)
+        elif scorer == 'commentary' and any([s in passage_text for s in story_config['passage']['stop']]):
+            aux_info['commentary_score'] = -1e10
+        elif scorer == 'coherence' and story.num_passages() == 0:
+            aux_info['coherence_score'] = 0
+        else:
+            remaining_scorers.append(scorer)
+    return aux_info, remaining_scorers
+
+
+def cascade_score_passages(indices, multiplicities, score, cheap_score, story_config):
+    # score candidates in decreasing order of an upper bound on their final score (cheap scores plus the max of each
+    # remaining scorer; the LLM scorers are log probabilities, so at most 0), and skip the LLM scorers for any candidate
+    # whose bound is strictly below the passage_beam_width-th best exact score among its siblings. such a candidate
+    # can't be selected by filter_beam, so selections match exhaustive scoring. skipped candidates keep their bound
+    # as their score and are marked as pruned.
+    beam_width = story_config['passage_beam_width']
+    cheap = [cheap_score(i) for i in indices]
+    upper_bounds = [sum([aux_info.get(f'{scorer}_score', 0) for scorer in story_config['score']['scorers']]) for aux_info, _ in cheap]
+    order = sorted(range(len(indices)), key=lambda j: upper_bounds[j], reverse=True)
+    results = [None] * len(indices)
+    exact_scores = []
+    position = 0
+    while position < len(order):
+        expanded_scores = sorted([exact_score for exact_score, multiplicity in exact_scores for _ in range(multiplicity)], reverse=True)
+        threshold = expanded_scores[beam_width - 1] if len(expanded_scores) >= beam_width else None
+        if threshold is not None and upper_bounds[order[position]] < threshold:
+            break
+        # score the next few candidates concurrently; scoring more than strictly needed never changes the result
+        batch = [j for j in order[position:position + beam_width] if threshold is None or upper_bounds[j] >= threshold]
+        for j, aux_info in zip(batch, concurrent_map(lambda j: score(indices[j], scorers=cheap[j][1], aux_info=cheap[j][0]), batch)):
+            results[j] = aux_info
+            exact_scores.append((aux_info['score'], multiplicities[j]))
+        position += len(batch)
+    for j in order[position:]:
+        results[j] = dict(cheap[j][0], score=upper_bounds[j], pruned=True)
+    if position < len(order):
+        logging.debug(f"Cascade scoring pruned {len(order) - position} of {len(order)} distinct candidates")
+    return results
+
+
+def postprocess_passage_text(passage_text, story_config):
+    passage_text = passage_text.rstrip()
+    if story_config.get('include_prefix_space', False) and not passage_text.startswith(' '):
+        passage_text = ' ' + passage_text
+        passage_text = passage_text.replace('  ', ' ')
+    return passage_text
+
+
+@traced()
+def score_passage(passage_text, finish_reason, story, node, story_config, story_prompts, llm_client, is_ending=False, score_cache=None, scorers=None, aux_info=None):
+    # runs the given scorers (default all) on top of any scores already in aux_info, and totals them in config order
+    aux_info = dict(aux_info) if aux_info is not None else {}
+    for scorer in (scorers if scorers is not None else story_config['score']['scorers']):
+        if scorer == 'coherence':
+            scorer_score = score_coherence(passage_text, story, story_config, story_prompts, llm_client, score_cache=score_cache)
+        elif scorer == 'relevance':
+            scorer_score = score_relevance(passage_text, story, node, story_config, story_prompts, llm_client, score_cache=score_cache)
+        elif scorer == 'commentary':
+            scorer_score = score_commentary(passage_text, story_config, story_prompts, llm_client, score_cache=score_cache)
+        elif scorer == 'length':
+            scorer_score = score_length(finish_reason, is_ending=is_ending)
+        else:
+            raise NotImplementedError
+        aux_info[f'{scorer}_score'] = scorer_score
+    aux_info['score'] = sum([aux_info[f'{scorer}_score'] for scorer in story_config['score']['scorers']])
+    return aux_info
+
+
+def cached_llm_score(score_cache, scorer, prompt_inputs, compute):
+    # scorer judgments are deterministic given the exact prompt inputs, so reuse them when beams reconverge
+    if score_cache is None:
+        return compute()
+    key = (scorer, hashlib.sha1('\0'.join(prompt_inputs).encode('utf-8')).hexdigest())
+    return score_cache.get_or_compute(key, compute)
+
+
+def score_coherence(passage_text, story, story_config, story_prompts, llm_client, score_cache=None):
+    if story.num_passages() == 0:
+        return 0
+    try:
+        coherence_prefix = story.last_passages(story_config['score']['coherence']['max_prefix_passages'])
+        coherence_prefix = ''.join([p.text for p in coherence_prefix])
+        def compute():
+            _, coherence_score_completion = llm_client.call_with_retry(
+                story_prompts['score']['coherence'].format(
+                    prefix=coherence_prefix.strip(),
+                    continuation=passage_text.strip()
+                ),
+                SamplingConfig.from_config(story_config['score']['coherence']),
+                filter=lambda s: len(s.strip()) > 0,
+                return_full_completion=True,
+                priority='low', # scoring is off the critical path
+                stage='coherence'
+            )
+            yes_no_logprobs = extract_choice_logprobs(coherence_score_completion, default_logprobs=[-1e8, -1e7])
+            return yes_no_logprobs[0][0] # logprob of yes
+        return cached_llm_score(score_cache, 'coherence', [coherence_prefix.strip(), passage_text.strip()], compute)
+    except:
+        logging.warning(f"Failed to score coherence for passage: {passage_text}")
+        return -1e10
+
+
+def score_relevance(passage_text, story, node, story_config, story_prompts, llm_client, score_cache=None):
+    try:
+        continuation = (''.join([p.text for p in story.passage_lists[-1].passages] + [passage_text])).strip()
+        def compute():
+            _, relevance_score_completion = llm_client.call_with_retry(
+                story_prompts['score']['relevance'].format(
+                    node_event=node.text.strip(),
+                    continuation=continuation,
+                ),
+                SamplingConfig.from_config(story_config['score']['relevance']),
+                filter=lambda s: len(s.strip()) > 0,
+                return_full_completion=True,
+                priority='low', # scoring is off the critical path
+                stage='relevance'
+            )
+            yes_no_logprobs = extract_choice_logprobs(relevance_score_completion, default_logprobs=[-1e8, -1e7])
+            return yes_no_logprobs[0][0] # logprob of yes
+        return cached_llm_score(score_cache, 'relevance', [node.text.strip(), continuation], compute)
+    except:
+        logging.warning(f"Failed to score relevance for passage: {passage_text}")
+        return -1e10
+
+
+def score_commentary(passage_text, story_config, story_prompts, llm_client, score_cache=None):
+    if any([s in passage_text for s in story_config['passage']['stop']]):
+        return -1e10
+    try:
+        last_paragraph = passage_text.rsplit('\n', 1)[-1].strip()
+        def compute():
+            _, commentary_score_completion = llm_client.call_with_retry(
+                story_prompts['score']['commentary'].format(
+                    last_paragraph=last_paragraph
+                    # continuation=passage_text
+                ),
+                SamplingConfig.from_config(story_config['score']['commentary']),
+                filter=lambda s: len(s.strip()) > 0,
+                return_full_completion=True,
+                priority='low', # scoring is off the critical path
+                stage='commentary'
+            )
+            story_commentary_logprobs = extract_choice_logprobs(commentary_score_completion, choices=['A', 'B'], default_logprobs=[-1e8, -1e7], case_sensitive=True)
+            return story_commentary_logprobs[0][0] # logprob of A (it's asking whether it's story or commentary; we want it to be a story)
+            # yes_no_logprobs = extract_choice_logprobs(commentary_score_completion)
+            # return yes_no_logprobs[0][1] # logprob of no; we don't want commentary at the end
+        return cached_llm_score(score_cache, 'commentary', [last_paragraph], compute)
+    except:
+        logging.warning(f"Failed to score commentary for passage: {passage_text}")
+        return -1e10
+
+
+def score_length(finish_reason, is_ending=False):
+    if finish_reason == 'length':
+        return 0
+    if is_ending:
+        # we want to stop early when trying to end the story
+        return 100
+    # penalize for not finishing due to length - we don't want things that stopped early instead of continuing in the story text style.
+    return -100
 
 
 def filter_beam(beam, beam_width=1, aux_attr='score'):
@@ -328,23 +610,24 @@ def filter_beam(beam, beam_width=1, aux_attr='score'):
     return StoryBeam(filtered_story_candidates)
 
 
-def end_story(beam, plan, story_config, story_prompts, llm_client):
+@traced()
+def end_story(beam, plan, story_config, story_prompts, llm_client, **kwargs):
     if story_config['ending_policy'] == 'none':
         pass
     elif story_config['ending_policy'] == 'append-passage':
         new_stories = []
-        for story in beam:
-            passages = render_passage(story, story.rendered_nodes()[-1], story_config, story_prompts, llm_client, is_ending=True)
+        for story, passages in zip(beam, concurrent_map(lambda story: render_passage(story, story.passage_lists[-1].outline_node, story_config, story_prompts, llm_client, is_ending=True, **kwargs), beam)):
             new_stories.append(story.copy_append_passage(passages[0]))
         beam = StoryBeam(new_stories)
     elif story_config['ending_policy'] == 'append-node':
-        plan = deepcopy(plan)
+        # copy-on-write: only the outline root is copied to add the end node, and the rest of the plan is shared
+        plan = plan.with_outline(plan.outline.shallow_copy())
         previous_node = beam.rendered_nodes()[-1]
         end_node = OutlineNode('The conclusion of the story.', plan.outline, scene=previous_node.scene, entities=previous_node.entities)
         plan.outline.children.append(end_node)
         next_story_candidates = []
-        for story in beam:
-            next_story_candidates += render_node(story, end_node, story_config, story_prompts, llm_client, is_ending=True).stories
+        for rendered_beam in concurrent_map(lambda story: render_node(story, end_node, story_config, story_prompts, llm_client, is_ending=True, **kwargs), beam):
+            next_story_candidates += rendered_beam.stories
         beam = filter_beam(StoryBeam(next_story_candidates), story_config['outline_node_beam_width'], aux_attr='score')
     else:
         raise NotImplementedError